@@ -0,0 +1,4 @@
+"""
+Load testing tools: a bulk generator of synthetic social graphs, and
+benchmarks of the api requests made by the frontend. See __main__.py.
+"""
@@ -0,0 +1,107 @@
+"""
+Benchmarks the requests made by the frontend against a synthetic social
+graph, in a throwaway test database, reporting queries per request and p50
+and p99 latency. Run from the repository root:
+
+    python -m benchmark --users 1000 --followers 50 --requests 100
+"""
+import argparse
+import logging
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project4.settings')
+django.setup()
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import (
+    setup_test_environment,
+    teardown_test_environment,
+)
+
+from network.models import Post, User
+
+from .graph import generate_graph
+from .suite import BENCHMARKS, Context, run_benchmark
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m benchmark')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help=f'Benchmarks to run, from {list(BENCHMARKS)}. '
+                             f'All are run by default.')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Number of users to generate')
+    parser.add_argument('--followers', type=int, default=20,
+                        help='Mean followers per user')
+    parser.add_argument('--posts', type=int, default=5,
+                        help='Mean posts per user')
+    parser.add_argument('--likes', type=int, default=10,
+                        help='Mean likes per post')
+    parser.add_argument('--skew', type=float, default=1.5,
+                        help='Shape of the follower and like power law, '
+                             'lower for a longer tail')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed, so runs can be reproduced')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='Requests sent per benchmark, at least 2')
+    parser.add_argument('--cached', action='store_true',
+                        help='Let searches be served from the response cache')
+
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks {sorted(unknown)}')
+    if args.requests < 2:
+        parser.error('at least 2 requests are needed for percentiles')
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.getLogger('network').setLevel(logging.WARNING)
+
+    setup_test_environment()
+    database = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        start = time.perf_counter()
+        sizes = generate_graph(
+            args.users, args.followers, args.posts, args.likes, args.skew,
+            args.seed
+        )
+        print(', '.join(f'{count} {name}' for name, count in sizes.items())
+              + f' generated in {time.perf_counter() - start:.1f}s')
+
+        # benchmark as the user following the most others, with a post of
+        # their own to edit
+        user = User.objects.order_by('-leader_total', 'pk').first()
+        if not user.posts.exists():
+            Post.objects.create(user=user, content='Benchmark')
+
+        context = Context(
+            user, dict(User.objects.values_list('pk', 'username')),
+            list(Post.objects.values_list('pk', flat=True)),
+            random.Random(args.seed)
+        )
+        client = Client()
+        client.force_login(user)
+
+        print(f'{"benchmark":<24}{"queries":>10}{"p50 ms":>10}{"p99 ms":>10}')
+        for name in args.names or BENCHMARKS:
+            result = run_benchmark(
+                BENCHMARKS[name], client, context, args.requests, args.cached
+            )
+            print(f'{name:<24}{result["queries"]:>10.1f}'
+                  f'{result["p50"]:>10.2f}{result["p99"]:>10.2f}')
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from demo.lorem import LOREM
+from network.models import Post, Timeline, User, use_timeline
+from network.utils import bump_generation
+
+# rows written per bulk insert or update
+BATCH_SIZE = 1000
+
+
+def power_law(rng, mean, maximum, skew):
+    """
+    Random count drawn from a Pareto distribution, so most are small and a
+    few are very large, as with followers and likes on a social network.
+    :param rng: :class:`random.Random` instance
+    :param mean: Mean of the distribution
+    :param maximum: Largest count returned
+    :param skew: Shape of the distribution, must be greater than 1. Lower
+                 values give a longer tail.
+    :rtype: int
+    """
+    scale = mean * (skew - 1) / skew
+    return min(int(rng.paretovariate(skew) * scale), maximum)
+
+
+def post_content(rng):
+    """Random lorem ipsum post of up to 140 characters"""
+    words = list()
+    for _ in range(rng.randint(5, 30)):
+        word = rng.choice(LOREM)
+        if sum(len(w) + 1 for w in words) + len(word) > 140:
+            break
+        words.append(word)
+    return ' '.join(words)
+
+
+def link(model, field, pairs):
+    """
+    Inserts rows straight into the through table of a many-to-many field
+    :param model: Model class with the field
+    :param field: Name of many-to-many field
+    :param pairs: (model id, linked model id) pairs to link
+    :return: Number of links inserted
+    """
+    through, source, target = model.through_table(field)
+    through.objects.bulk_create(
+        [through(**{source: pk, target: value}) for pk, value in pairs],
+        batch_size=BATCH_SIZE, ignore_conflicts=True
+    )
+    return len(pairs)
+
+
+def generate_graph(users=100, followers=10, posts=5, likes=5, skew=1.5,
+                   seed=1, password='benchmark'):
+    """
+    Creates a synthetic social graph with bulk inserts, so large graphs can
+    be generated in seconds. Follower and like counts follow a power law, so
+    a few users and posts are far more popular than the rest.
+    :param users: Number of users to create
+    :param followers: Mean number of followers per user
+    :param posts: Mean number of posts per user
+    :param likes: Mean number of likes per post
+    :param skew: Shape of the follower and like distributions, see
+                 :func:`power_law`
+    :param seed: Random seed, so graphs can be reproduced
+    :param password: Password of every created user, named bench<n>
+    :return: Number of users, follows, posts and likes created
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    with transaction.atomic():
+        last_user = User.objects.aggregate(pk=Max('pk'))['pk'] or 0
+        last_post = Post.objects.aggregate(pk=Max('pk'))['pk'] or 0
+
+        # hashing is slow, so every user shares the same hash
+        hashed = make_password(password)
+        User.objects.bulk_create([
+            User(username=f'bench{last_user + i}', password=hashed)
+            for i in range(users)
+        ], batch_size=BATCH_SIZE)
+        user_ids = list(User.objects.filter(
+            pk__gt=last_user
+        ).values_list('pk', flat=True))
+
+        follows = list()
+        for leader in user_ids:
+            count = power_law(rng, followers, len(user_ids) - 1, skew)
+            follows.extend(
+                (leader, follower)
+                for follower in rng.sample(user_ids, count + 1)
+                if follower != leader
+            )
+
+        Post.objects.bulk_create([
+            Post(user_id=user, content=post_content(rng))
+            for user in user_ids
+            for _ in range(rng.randint(0, 2 * posts))
+        ], batch_size=BATCH_SIZE)
+
+        # timestamps are set on insert, so spread them out afterwards
+        new_posts = list(
+            Post.objects.filter(pk__gt=last_post).only('pk', 'user')
+        )
+        for post in new_posts:
+            post.timestamp = now - datetime.timedelta(
+                seconds=rng.randint(1, 10000000)
+            )
+        Post.objects.bulk_update(
+            new_posts, ['timestamp'], batch_size=BATCH_SIZE
+        )
+
+        post_likes = list()
+        for post in new_posts:
+            count = power_law(rng, likes, len(user_ids), skew)
+            post_likes.extend(
+                (post.pk, user) for user in rng.sample(user_ids, count)
+            )
+
+        result = {
+            'users': len(user_ids),
+            'follows': link(User, 'followers', follows),
+            'posts': len(new_posts),
+            'likes': link(Post, 'likes', post_likes),
+        }
+
+        # links were written directly, so bring denormalized data up to date
+        User.reconcile_counters()
+        Post.reconcile_counters()
+        if use_timeline():
+            for i in range(0, len(new_posts), BATCH_SIZE):
+                Timeline.fan_out(new_posts[i:i + BATCH_SIZE])
+
+    bump_generation(User, Post)
+    return result
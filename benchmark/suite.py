@@ -0,0 +1,163 @@
+import json
+import statistics
+import time
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .graph import post_content
+
+# fields requested by the frontend's profile page
+PROFILE_FIELDS = [
+    'username', 'follower_count', 'leader_count', 'can_follow',
+    'is_following', 'is_self', 'id', {'leaders': ['id']}
+]
+
+
+class Context(object):
+    """
+    State shared by benchmarks: the logged in user, users and posts to pick
+    request targets from, and a seeded random number generator.
+    """
+
+    def __init__(self, user, usernames, post_ids, rng):
+        """
+        :param user: User the client is logged in as
+        :param usernames: Usernames of users to pick from, by id
+        :param post_ids: Ids of posts to pick from
+        :param rng: :class:`random.Random` instance
+        """
+        self.own_post_ids = list(user.posts.values_list('pk', flat=True))
+        self.user = user
+        self.usernames = usernames
+        self.user_ids = list(usernames)
+        self.post_ids = post_ids
+        self.rng = rng
+
+
+def search(client, **query):
+    """Sends a search as the frontend does, with the query in q"""
+    return client.get('/api/v1/search', {'q': json.dumps(query)})
+
+
+def post_json(client, url, data):
+    return client.post(
+        url, json.dumps(data), content_type='application/json'
+    )
+
+
+def all_posts(client, context):
+    return search(
+        client, model='post', fields=True, order='-timestamp', page=1
+    )
+
+
+def next_page(client, context):
+    return search(
+        client, model='post', fields=True, order='-timestamp', page=2
+    )
+
+
+def feed(client, context):
+    return search(
+        client, model='post', fields=True, order='-timestamp', page=1,
+        filters=[{'user__followers': {'is': context.user.pk}}]
+    )
+
+
+def profile(client, context):
+    user = context.rng.choice(context.user_ids)
+    return search(
+        client, model='user', fields=PROFILE_FIELDS, limit=1, page=1,
+        filters=[{'username': {'is': context.usernames[user]}}]
+    )
+
+
+def profile_posts(client, context):
+    user = context.rng.choice(context.user_ids)
+    return search(
+        client, model='post', fields=True, order='-timestamp', page=1,
+        filters=[{'user': {'is': user}}]
+    )
+
+
+def edit_post(client, context):
+    return post_json(client, '/api/v1/update', {'data': [{
+        'model': 'post', 'id': context.rng.choice(context.own_post_ids),
+        'content': post_content(context.rng),
+    }]})
+
+
+def like(client, context):
+    return post_json(client, '/api/v1/like', {
+        'id': context.rng.choice(context.post_ids),
+        'like': context.rng.random() < 0.5,
+    })
+
+
+def follow(client, context):
+    leader = context.rng.choice(context.user_ids)
+    while leader == context.user.pk:
+        leader = context.rng.choice(context.user_ids)
+    return post_json(client, '/api/v1/follow', {
+        'id': leader, 'follow': context.rng.random() < 0.5,
+    })
+
+
+def create(client, context):
+    return post_json(client, '/api/v1/create', {
+        'model': 'post', 'content': post_content(context.rng)
+    })
+
+
+# requests made by the frontend, by name
+BENCHMARKS = {
+    'search all posts': all_posts,
+    'search next page': next_page,
+    'search feed': feed,
+    'search profile': profile,
+    'search profile posts': profile_posts,
+    'update post': edit_post,
+    'like toggle': like,
+    'follow toggle': follow,
+    'create post': create,
+}
+
+
+def run_benchmark(func, client, context, requests, cached=False):
+    """
+    Sends a request repeatedly, timing it and counting its queries
+    :param func: Benchmark from :data:`BENCHMARKS`
+    :param client: Test client logged in as the context user
+    :param context: :class:`Context` of the benchmark
+    :param requests: Number of requests to send, at least 2
+    :param cached: Whether searches may be served from the response cache,
+                   otherwise it is cleared before each request
+    :return: Mean queries per request, and p50 and p99 latency in ms
+    :rtype: dict
+    :raises: AssertionError if a request fails
+    """
+    durations = list()
+    queries = list()
+    for _ in range(requests):
+        if not cached:
+            cache.clear()
+
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = func(client, context)
+            durations.append(time.perf_counter() - start)
+        queries.append(len(captured))
+
+        assert response.status_code == 200, (
+            f'{func.__name__} failed with {response.status_code}: '
+            f'{response.content[:200]}'
+        )
+
+    percentiles = statistics.quantiles(durations, n=100, method='inclusive')
+    return {
+        'queries': statistics.mean(queries),
+        'p50': percentiles[49] * 1000,
+        'p99': percentiles[98] * 1000,
+    }
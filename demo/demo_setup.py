@@ -67,3 +67,6 @@ for post in Post.objects.all():
     fans.extend(new_fans)
     post.likes.set(fans)
     post.save()
+
+# links above were written directly, so bring counter columns up to date
+os.system(f'python {os.path.dirname(__file__)}/../manage.py reconcile_counters')
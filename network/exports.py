@@ -0,0 +1,55 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import User, Post
+
+# kinds of records that can be exported, in export order
+EXPORTS = ('users', 'posts', 'follows', 'likes')
+
+# public fields of each exported model
+USER_FIELDS = ['id', 'username', 'date_joined']
+POST_FIELDS = ['id', 'user', 'content', 'timestamp']
+
+
+def export_records(kind, chunk_size=2000):
+    """
+    Streams every record of a kind, tagged with the model it describes.
+    :param kind: One of :data:`EXPORTS`
+    :param chunk_size: Number of records read from the database at once
+    :raises: ValueError if kind is invalid
+    :return: generator of json serializable dictionaries
+    """
+    if kind == 'users':
+        for user in User.export(USER_FIELDS, chunk_size):
+            yield {'model': 'user', **user}
+    elif kind == 'posts':
+        for post in Post.export(POST_FIELDS, chunk_size):
+            yield {'model': 'post', **post}
+    elif kind == 'follows':
+        for leader, follower in User.export_links('followers', chunk_size):
+            yield {'model': 'follow', 'leader': leader, 'follower': follower}
+    elif kind == 'likes':
+        for post, user in Post.export_links('likes', chunk_size):
+            yield {'model': 'like', 'post': post, 'user': user}
+    else:
+        raise ValueError(f'invalid export - {kind}')
+
+
+def export_lines(kinds=EXPORTS, chunk_size=2000):
+    """
+    Streams records of each kind as newline delimited json (NDJSON)
+    :param kinds: Kinds of records to export, from :data:`EXPORTS`
+    :param chunk_size: Number of records read from the database at once
+    :raises: ValueError if any kind is invalid, before exporting anything
+    :return: generator of lines
+    """
+    invalid = set(kinds).difference(EXPORTS)
+    if invalid:
+        raise ValueError(f'invalid exports - {sorted(invalid)}')
+
+    return (
+        json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+        for kind in kinds
+        for record in export_records(kind, chunk_size)
+    )
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from network.models import Post, Timeline
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds home feed timelines by fanning out every existing post'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of posts fanned out per batch'
+        )
+
+    def handle(self, *args, **options):
+        Timeline.objects.all().delete()
+
+        chunk_size = options['chunk_size']
+        posts = list()
+        for post in Post.objects.iterator(chunk_size=chunk_size):
+            posts.append(post)
+            if len(posts) == chunk_size:
+                Timeline.fan_out(posts)
+                posts = list()
+        if posts:
+            Timeline.fan_out(posts)
+
+        self.stdout.write(f'{Timeline.objects.count()} timeline entries')
@@ -0,0 +1,124 @@
+import re
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import BooleanField, DateTimeField, IntegerField
+from django.utils import timezone
+
+from network.utils import ModelExtension
+from network.views import MAX_RECORDS
+
+
+# searches made by the frontend, as (model, filters, order)
+# filter values are filled in with a sample value for the field
+FRONTEND_SEARCHES = (
+    ('post', None, '-timestamp'),
+    ('post', ['user'], '-timestamp'),
+    ('post', ['user__followers'], '-timestamp'),
+    ('user', ['username'], None),
+)
+
+# lines of query plans that read a whole table
+TABLE_SCANS = {
+    'sqlite': re.compile(r'SCAN \w+$'),
+    'postgresql': re.compile(r'Seq Scan'),
+    'mysql': re.compile(r'type=ALL'),
+}
+
+# lines of query plans that sort the whole result set to find a page
+SORTS = {
+    'sqlite': re.compile(r'USE TEMP B-TREE FOR ORDER BY'),
+    'postgresql': re.compile(r'Sort'),
+    'mysql': re.compile(r'Using filesort'),
+}
+
+
+def sample_value(field):
+    """Value of the right type to filter the given model field by"""
+    if isinstance(field, DateTimeField):
+        return timezone.now()
+    elif field.is_relation or isinstance(field, IntegerField):
+        return 1
+    elif isinstance(field, BooleanField):
+        return True
+    return ''
+
+
+class Command(BaseCommand):
+    help = (
+        'Explains the queries run by the search api for each filter and '
+        'order it accepts, and reports those that fall back to full table '
+        'scans or sorts. Unfiltered searches may scan in index order, as '
+        'they stop after one page. Run against a populated database, as '
+        'planners prefer scanning small tables.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verbose-plans', action='store_true',
+            help='Print the query plan of every search, not just full scans'
+        )
+
+    def searches(self):
+        """Yields every search shape to explain, as (model, filters, order)"""
+        for model_name, filters, order in FRONTEND_SEARCHES:
+            yield apps.get_model('network', model_name), filters, order
+
+        for model in apps.get_app_config('network').get_models():
+            if not issubclass(model, ModelExtension):
+                continue
+            for field in sorted(model.default_fields()):
+                yield model, [field], None
+                yield model, None, field
+                yield model, None, f'-{field}'
+
+    def handle(self, *args, **options):
+        table_scan = TABLE_SCANS.get(connection.vendor)
+        sort = SORTS.get(connection.vendor)
+        if table_scan is None and not options['verbose_plans']:
+            self.stderr.write(
+                f'Full scan detection not supported for {connection.vendor}'
+                f', run with --verbose-plans to print the query plans'
+            )
+            return
+
+        scans = 0
+        for model, filter_fields, order in self.searches():
+            filters = [
+                {f: {'is': sample_value(model.filter_field(f))}}
+                for f in filter_fields or []
+            ]
+            includes, excludes = model.parse_filters(filters)
+            values = model.objects.filter(**includes).exclude(**excludes)
+            values = model.order_by(order, values)[:MAX_RECORDS]
+
+            plan = values.explain()
+            lines = plan.splitlines()
+            if table_scan is not None:
+                lines = [
+                    line for line in lines
+                    if sort.search(line) or
+                    (filters and table_scan.search(line))
+                ]
+
+            search = (
+                f'{model._meta.model_name} '
+                f'filters={filter_fields} order={order}'
+            )
+            if table_scan is None:
+                # plans can't be classified, so they are only printed
+                self.stdout.write(f'PLAN {search}')
+            elif lines:
+                scans += 1
+                self.stdout.write(self.style.WARNING(f'FULL SCAN {search}'))
+            elif options['verbose_plans']:
+                self.stdout.write(f'OK {search}')
+
+            if options['verbose_plans']:
+                lines = plan.splitlines()
+            for line in lines:
+                self.stdout.write(f'    {line}')
+
+        if table_scan is not None:
+            self.stdout.write(f'{scans} searches fall back to full scans')
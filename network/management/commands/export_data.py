@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from network.exports import EXPORTS, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Exports posts and the social graph as newline delimited json'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'kinds', nargs='*',
+            help=f'Kinds of records to export, any of {", ".join(EXPORTS)}. '
+            f'Defaults to all'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Number of records read from the database at once'
+        )
+        parser.add_argument(
+            '--output',
+            help='File to write the export to, defaults to stdout'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            lines = export_lines(
+                options['kinds'] or EXPORTS, options['chunk_size']
+            )
+        except ValueError as v:
+            raise CommandError(v)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
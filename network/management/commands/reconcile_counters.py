@@ -0,0 +1,25 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from network.utils import ModelExtension
+
+
+class Command(BaseCommand):
+    help = 'Recounts counter columns, correcting drift from direct writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report drifted rows without correcting them'
+        )
+
+    def handle(self, *args, **options):
+        for model in apps.get_app_config('network').get_models():
+            if not issubclass(model, ModelExtension):
+                continue
+
+            drift = model.reconcile_counters(dry_run=options['dry_run'])
+            for column, rows in drift.items():
+                self.stdout.write(
+                    f'{model._meta.label}.{column}: {rows} drifted rows'
+                )
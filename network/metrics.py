@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from .utils import cached_field_plan
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# type and help text of each metric
+METRICS = {
+    'network_request_duration_seconds': (
+        'histogram', 'Request latency by view and searched model'
+    ),
+    'network_requests_total': (
+        'counter', 'Requests by view and response status'
+    ),
+    'network_request_errors_total': (
+        'counter', 'Rejected requests by view and failed validation step'
+    ),
+    'network_search_cache_total': (
+        'counter', 'Search response cache lookups by result'
+    ),
+    'network_cache_entries': (
+        'gauge', 'Entries in the local memory cache'
+    ),
+    'network_field_plans': (
+        'gauge', 'Compiled field plans cached'
+    ),
+    'network_like_buffer_pending': (
+        'gauge', 'Likes queued in the write-behind buffer'
+    ),
+}
+
+
+def metrics_dir():
+    """
+    Directory shared by every process serving the app, where each writes
+    its metrics so any of them can expose the totals. Set by the
+    NETWORK_METRICS_DIR setting. If None, only the serving process's
+    metrics are exposed.
+    :rtype: str
+    """
+    return getattr(settings, 'NETWORK_METRICS_DIR', None)
+
+
+def metrics_interval():
+    """
+    Minimum seconds between writes of a process's metrics to
+    :func:`metrics_dir`, as set by the NETWORK_METRICS_INTERVAL setting.
+    :rtype: float
+    """
+    return getattr(settings, 'NETWORK_METRICS_INTERVAL', 10.0)
+
+
+def metrics_token():
+    """
+    Bearer token that lets scrapers read the metrics endpoint without
+    logging in, as set by the NETWORK_METRICS_TOKEN setting. If None, only
+    staff users can read it.
+    :rtype: str
+    """
+    return getattr(settings, 'NETWORK_METRICS_TOKEN', None)
+
+
+def format_labels(labels, **extra):
+    """Formats labels for the text exposition format, e.g. {view="search"}"""
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n')
+
+    pairs = ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+    return f'{{{pairs}}}'
+
+
+class Registry(object):
+    """
+    Thread safe, in-process registry of counters, histograms and gauges.
+    Counters and histograms are recorded as they happen, gauges are read
+    from callables when metrics are collected.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # snapshots are taken under _lock, so writes need their own
+        self._write_lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = dict()
+        self._gauges = dict()
+        self._written = 0.0
+
+    def inc(self, name, value=1, **labels):
+        """Increments a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        """Records a value in a histogram with :data:`LATENCY_BUCKETS`"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0,
+                      'count': 0}
+            )
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def gauge(self, name, func):
+        """Registers a callable that returns the current value of a gauge"""
+        self._gauges[name] = func
+
+    def snapshot(self):
+        """
+        Current value of every metric, in a json serializable format
+        :rtype: dict
+        """
+        gauges = list()
+        for name, func in self._gauges.items():
+            try:
+                gauges.append([name, [], func()])
+            except Exception:
+                # a failing gauge shouldn't take the others down with it
+                continue
+
+        with self._lock:
+            return {
+                'time': time.time(),
+                'counters': [
+                    [name, list(labels), value]
+                    for (name, labels), value in self._counters.items()
+                ],
+                'histograms': [
+                    [name, list(labels), dict(histogram,
+                                              buckets=histogram['buckets'][:])]
+                    for (name, labels), histogram in self._histograms.items()
+                ],
+                'gauges': gauges,
+            }
+
+    def write(self, force=False):
+        """
+        Writes this process's metrics to :func:`metrics_dir`, at most every
+        :func:`metrics_interval` seconds unless forced. Failed writes are
+        logged rather than raised, so they never fail a request.
+        """
+        directory = metrics_dir()
+        if not directory:
+            return
+
+        with self._write_lock:
+            now = time.time()
+            if not force and now - self._written < metrics_interval():
+                return
+            self._written = now
+
+            # write to a temporary file then rename, so readers never see
+            # a partial file
+            path = os.path.join(directory, f'{os.getpid()}.json')
+            try:
+                fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(self.snapshot(), f)
+                    os.replace(temp, path)
+                except BaseException:
+                    os.unlink(temp)
+                    raise
+            except OSError:
+                logger.exception(f'Failed to write metrics to {path}')
+
+    def collect(self):
+        """
+        Metrics of every process that wrote to :func:`metrics_dir`, or only
+        the current process if not set. Counters and histograms are summed.
+        Gauges are summed over processes that wrote recently, so stopped
+        processes don't count.
+        :rtype: dict
+        """
+        directory = metrics_dir()
+        if not directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.write(force=True)
+            snapshots = list()
+            for name in os.listdir(directory):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        counters = defaultdict(float)
+        histograms = dict()
+        gauges = defaultdict(float)
+        stale = time.time() - 3 * metrics_interval()
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, histogram in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0,
+                    'count': 0
+                })
+                for i, count in enumerate(histogram['buckets']):
+                    total['buckets'][i] += count
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+            if snapshot['time'] >= stale:
+                for name, labels, value in snapshot['gauges']:
+                    gauges[(name, tuple(map(tuple, labels)))] += value
+
+        return {
+            'counters': counters, 'histograms': histograms, 'gauges': gauges
+        }
+
+    def exposition(self):
+        """
+        Collected metrics in the Prometheus text exposition format
+        :rtype: str
+        """
+        collected = self.collect()
+        samples = defaultdict(list)
+
+        for (name, labels), value in collected['counters'].items():
+            samples[name].append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), value in collected['gauges'].items():
+            samples[name].append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), histogram in collected['histograms'].items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                cumulative += count
+                samples[name].append(
+                    f'{name}_bucket{format_labels(labels, le=bound)} '
+                    f'{cumulative}'
+                )
+            samples[name].append(
+                f'{name}_bucket{format_labels(labels, le="+Inf")} '
+                f'{histogram["count"]}'
+            )
+            samples[name].append(
+                f'{name}_sum{format_labels(labels)} {histogram["sum"]}'
+            )
+            samples[name].append(
+                f'{name}_count{format_labels(labels)} {histogram["count"]}'
+            )
+
+        lines = list()
+        for name, (kind, description) in METRICS.items():
+            if name in samples:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.extend(sorted(samples[name]))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# the entry count is only known for the local memory cache
+if isinstance(caches['default'], LocMemCache):
+    registry.gauge('network_cache_entries', lambda: len(cache._cache))
+registry.gauge(
+    'network_field_plans', lambda: cached_field_plan.cache_info().currsize
+)
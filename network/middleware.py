@@ -0,0 +1,190 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import registry
+from .utils import SerializeProfile, profile_serialize
+
+logger = logging.getLogger('network.requests')
+
+
+def log_sample_rate(view):
+    """
+    Fraction of requests to a view that are logged, from the
+    NETWORK_LOG_SAMPLING setting, keyed by url name with 'default' for
+    views not listed.
+    :param view: Url name of the view, or None
+    :rtype: float
+    """
+    sampling = getattr(settings, 'NETWORK_LOG_SAMPLING', {})
+    return sampling.get(view, sampling.get('default', 1.0))
+
+
+def annotate(request, **fields):
+    """
+    Adds fields to the log line of a request, such as the number of rows
+    serialized or whether the response was cached. Ignored for requests that
+    did not pass through :class:`RequestLogMiddleware`.
+    """
+    log_fields = getattr(request, 'log_fields', None)
+    if log_fields is not None:
+        log_fields.update(fields)
+
+
+class QueryStats(object):
+    """
+    Database execute wrapper that counts and times queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class RequestLogMiddleware(object):
+    """
+    Logs a structured (json) line for each request, with its wall time,
+    database query count and time, response size and any fields added by
+    the view with :func:`annotate`. Requests are sampled at the rate set by
+    NETWORK_LOG_SAMPLING, if the logger is enabled for INFO, but failed
+    requests are always logged. Requests profiled by
+    :class:`SerializeProfileMiddleware` are always logged too, with the time
+    spent serializing each field.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.log_fields = dict()
+        request.serialize_profile = None
+        queries = QueryStats()
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.url_name if match else None
+        failed = response.status_code >= 400
+        if request.serialize_profile is not None:
+            request.log_fields['profile'] = (
+                request.serialize_profile.breakdown()
+            )
+        elif not failed and (
+                not logger.isEnabledFor(logging.INFO) or
+                random.random() >= log_sample_rate(view)):
+            return response
+
+        # streamed content is only produced after the request is logged
+        size = None
+        if not response.streaming:
+            size = len(response.content)
+
+        logger.log(
+            logging.WARNING if failed else logging.INFO,
+            json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                'user': getattr(request.user, 'pk', None),
+                'ms': round(duration * 1000, 2),
+                'queries': queries.count,
+                'query_ms': round(queries.duration * 1000, 2),
+                'bytes': size,
+                **request.log_fields,
+            }, default=str)
+        )
+
+        return response
+
+
+class SerializeProfileMiddleware(object):
+    """
+    Profiles the time spent serializing each field of a request, see
+    :class:`~network.utils.SerializeProfile`, if
+    :func:`~network.utils.profile_serialize`, or for staff users who opted
+    in with the X-Profile-Serialize header. Staff who opted in also get the
+    timings in the Server-Timing header, unless nothing was serialized. Must
+    come after the authentication middleware, and the profile is logged by
+    :class:`RequestLogMiddleware`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        opted_in = (
+            'X-Profile-Serialize' in request.headers and
+            getattr(request.user, 'is_staff', False)
+        )
+        if not opted_in and not profile_serialize():
+            return self.get_response(request)
+
+        with SerializeProfile() as profile:
+            response = self.get_response(request)
+        request.serialize_profile = profile
+
+        # cached responses aren't serialized again, so have no timings
+        breakdown = profile.breakdown()
+        if opted_in and breakdown:
+            response['Server-Timing'] = ', '.join(
+                f'{name};dur={timing["ms"]}'
+                for name, timing in breakdown.items()
+            )
+
+        return response
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Records the latency and status of each request in the metrics
+    :data:`~network.metrics.registry`, by view and the model and error
+    fields added with :func:`annotate`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = (match.url_name if match else None) or ''
+        fields = getattr(request, 'log_fields', {})
+        model = str(fields.get('model') or '').lower()
+
+        registry.observe(
+            'network_request_duration_seconds', duration,
+            view=view, model=model
+        )
+        registry.inc(
+            'network_requests_total', view=view,
+            status=response.status_code
+        )
+        if 'error' in fields:
+            registry.inc(
+                'network_request_errors_total', view=view,
+                error=fields['error']
+            )
+        if 'cache' in fields:
+            registry.inc('network_search_cache_total', result=fields['cache'])
+
+        registry.write()
+        return response
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:53
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+
+COUNTERS = (
+    # model   relation     column
+    ('post', 'likes', 'like_total'),
+    ('user', 'followers', 'follower_total'),
+    ('user', 'leaders', 'leader_total'),
+)
+
+
+def populate_counters(apps, schema_editor):
+    for model_name, relation, column in COUNTERS:
+        model = apps.get_model('network', model_name)
+        actual = model.objects.filter(
+            pk=OuterRef('pk')
+        ).annotate(actual=Count(relation)).values('actual')
+        model.objects.update(**{column: Subquery(actual)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0004_auto_20210221_1136'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='like_total',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='follower_total',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='leader_total',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0005_counter_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Timeline',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField()),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='network.post')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', 'timestamp', 'post'], name='timeline_owner_recent')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'post'), name='unique_timeline_post')],
+            },
+        ),
+    ]
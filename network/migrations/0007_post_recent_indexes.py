@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0006_timeline'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='posts', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['timestamp', 'id'], name='post_recent'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['user', 'timestamp', 'id'], name='post_user_recent'),
+        ),
+    ]
@@ -1,18 +1,55 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser, AnonymousUser
 from django.db import models
 
+from .metrics import registry
 from .utils import (
+    LinkBuffer,
     ModelExtension,
     field_label,
 )
 
+logger = logging.getLogger(__name__)
+
+# likes queued when NETWORK_LIKE_BUFFER is enabled
+like_buffer = LinkBuffer('network.Post', 'likes')
+registry.gauge('network_like_buffer_pending', like_buffer.size)
+
+
+def use_timeline():
+    """
+    Whether home feeds are read from the materialized :class:`Timeline`,
+    rather than joining through followers at read time. Enabled by the
+    NETWORK_TIMELINE setting.
+    :rtype: bool
+    """
+    return getattr(settings, 'NETWORK_TIMELINE', False)
+
+
+def fan_out_limit():
+    """
+    Follower count above which a user's posts are not fanned out to their
+    followers' timelines, and are merged into feeds at read time instead.
+    :rtype: int
+    """
+    return getattr(settings, 'NETWORK_TIMELINE_FAN_OUT_LIMIT', 1000)
+
 
 class User(ModelExtension, AbstractUser):
     followers = models.ManyToManyField('User', related_name='leaders')
+    follower_total = models.IntegerField(default=0, editable=False)
+    leader_total = models.IntegerField(default=0, editable=False)
 
     summary = field_label()
     contextual = field_label()
 
+    # fields users can edit on their own user, others such as is_staff,
+    # password and counter columns are only edited by superusers
+    EDITABLE_FIELDS = ('first_name', 'last_name', 'email', 'followers')
+
     def sanitize_context(self, user):
         # make sure we cast request user to at least anonymous user
         not_user = not isinstance(user, AbstractUser)
@@ -47,15 +84,15 @@ class User(ModelExtension, AbstractUser):
                 f'login required'
             )
         elif isinstance(context, AbstractUser) and not context.is_superuser:
-            # logged in users can edit fields on their own user, or add/remove
-            # themselves as followers of other users
+            # logged in users can edit profile fields on their own user, or
+            # add/remove themselves as followers of other users
             editing_self = (
-                    self.pk == context.pk or
-                    (field == 'followers' and value == context.pk)
+                    (self.pk == context.pk and field in self.EDITABLE_FIELDS)
+                    or (field == 'followers' and value == context.pk)
             )
             if not editing_self:
                 raise PermissionError(
-                    f'user may not edit other user fields'
+                    f'user may not edit field {field} of user {self.pk}'
                 )
         else:
             raise PermissionError(
@@ -65,12 +102,18 @@ class User(ModelExtension, AbstractUser):
         return True
 
     @property
-    @summary
+    @summary(
+        aggregate=models.Count('followers'),
+        counter=('followers', 'follower_total')
+    )
     def follower_count(self):
         return self.followers.count()
 
     @property
-    @summary
+    @summary(
+        aggregate=models.Count('leaders'),
+        counter=('leaders', 'leader_total')
+    )
     def leader_count(self):
         return self.leaders.count()
 
@@ -84,11 +127,13 @@ class User(ModelExtension, AbstractUser):
         return self._context.is_authenticated and self._context.pk != self.pk
 
     @property
-    @contextual
+    @contextual(membership='followers')
     def is_following(self):
 
         if self._context is None:
             self.set_context(self.sanitize_context(None))
+        if not self._context.is_authenticated:
+            return False
 
         return self.followers.filter(id=self._context.id).exists()
 
@@ -101,18 +146,59 @@ class User(ModelExtension, AbstractUser):
 
         return self.pk == self._context.pk
 
+    @classmethod
+    def relations_changed(cls, field, changes):
+        super().relations_changed(field, changes)
+
+        if use_timeline() and field in ('followers', 'leaders'):
+            # pairs of (leader, follower) ids
+            follows = list()
+            unfollows = list()
+            for pk, added, removed in changes:
+                if field == 'followers':
+                    follows.extend((pk, other) for other in added)
+                    unfollows.extend((pk, other) for other in removed)
+                else:
+                    follows.extend((other, pk) for other in added)
+                    unfollows.extend((other, pk) for other in removed)
+
+            if follows:
+                Timeline.follow(follows)
+            if unfollows:
+                Timeline.unfollow(unfollows)
+
+            deltas = defaultdict(int)
+            for leader, _ in follows:
+                deltas[leader] += 1
+            for leader, _ in unfollows:
+                deltas[leader] -= 1
+            Timeline.below_limit(deltas)
+
     @property
     def date_joined__serial(self):
         return self.date_joined.strftime('%c')
 
 
 class Post(ModelExtension, models.Model):
+    # indexed by post_user_recent, which also serves lookups by user alone
     user = models.ForeignKey(
-        'User', on_delete=models.CASCADE, related_name='posts'
+        'User', on_delete=models.CASCADE, related_name='posts',
+        db_index=False
     )
     content = models.CharField(max_length=140)
     timestamp = models.DateTimeField(auto_now_add=True)
     likes = models.ManyToManyField('User', related_name='liked_posts')
+    like_total = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # feeds are paged newest first, by timestamp with id tie-breaker,
+            # across all posts or for a single user
+            models.Index(fields=['timestamp', 'id'], name='post_recent'),
+            models.Index(
+                fields=['user', 'timestamp', 'id'], name='post_user_recent'
+            ),
+        ]
 
     summary = field_label()
     contextual = field_label()
@@ -152,14 +238,14 @@ class Post(ModelExtension, models.Model):
         elif isinstance(context, AbstractUser) and not context.is_superuser:
             # logged in users can only edit fields on their own posts
             editing_self = (
-                (self.user.pk == context.pk and field == 'content') or
+                (self.user_id == context.pk and field == 'content') or
                 (field == 'likes' and value == context.pk)
             )
             if not editing_self:
                 raise PermissionError(
                     f"user '{context.pk}' may not edit field '{field}' "
                     f"with value '{value}' on post '{self.id}' owned by "
-                    f"user '{self.user.pk}'"
+                    f"user '{self.user_id}'"
                 )
         else:
             raise PermissionError(
@@ -173,24 +259,64 @@ class Post(ModelExtension, models.Model):
         return self.timestamp.strftime('%c')
 
     @property
-    @summary
+    @summary(depends=('user__username', ))
     def username(self):
         return self.user.username
 
     @property
-    @summary
+    @summary(
+        aggregate=models.Count('likes'),
+        counter=('likes', 'like_total')
+    )
     def like_count(self):
         return self.likes.count()
 
     @property
-    @contextual
+    @contextual(membership='likes', buffer=like_buffer)
     def i_like(self):
 
         if self._context is None:
             self.set_context(self.sanitize_context(None))
+        if not self._context.is_authenticated:
+            return False
 
         return self.likes.filter(id=self._context.id).exists()
 
+    @classmethod
+    def feed(cls, user):
+        """
+        Posts by everyone the user follows, newest first.
+        :param user: User to build the feed for
+        :return: Queryset of posts, ordered
+        """
+        if not use_timeline():
+            return cls.objects.filter(user__followers=user).order_by(
+                '-timestamp', '-pk'
+            )
+
+        popular = User.objects.filter(
+            followers=user, follower_total__gt=fan_out_limit()
+        )
+        if not popular.exists():
+            # the timeline holds the whole feed, so pages are read in the
+            # order of its (owner, timestamp) index rather than sorting posts
+            return cls.objects.filter(timeline_entries__owner=user).order_by(
+                '-timeline_entries__timestamp', '-timeline_entries__post'
+            )
+
+        # posts by users too popular to fan out are merged in at read time,
+        # so the feed is sorted by the posts' own timestamps
+        fanned_out = Timeline.objects.filter(owner=user).values('post')
+        return cls.objects.filter(
+            models.Q(pk__in=fanned_out) |
+            models.Q(user__in=popular.values('pk'))
+        ).order_by('-timestamp', '-pk')
+
+    @classmethod
+    def on_created(cls, instances):
+        if use_timeline():
+            Timeline.fan_out(instances)
+
     @classmethod
     def create_from_post(cls, user=None, content=None, **kwargs):
         """
@@ -203,7 +329,136 @@ class Post(ModelExtension, models.Model):
         """
 
         if user is None:
-            print(f'Must provide user')
+            logger.info('Must provide user')
+            return
+
+        max_length = cls._meta.get_field('content').max_length
+        if not isinstance(content, str) or not 0 < len(content) <= max_length:
+            logger.info(f'Content must be 1 to {max_length} characters')
             return
 
         return cls(user=user, content=content)
+
+
+class Timeline(models.Model):
+    """
+    Materialized home feed, with a row for each post fanned out to each of
+    its author's followers when it was created, or when the follow started.
+    """
+    owner = models.ForeignKey(
+        'User', on_delete=models.CASCADE, related_name='+'
+    )
+    post = models.ForeignKey(
+        'Post', on_delete=models.CASCADE, related_name='timeline_entries'
+    )
+    # copied from the post, so feeds are paged by the timeline's own index
+    timestamp = models.DateTimeField()
+
+    # number of a leader's most recent posts added to a new follower's
+    # timeline when they start following
+    BACKFILL = 100
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'post'], name='unique_timeline_post'
+            ),
+        ]
+        indexes = [
+            # feeds are paged newest first, with the post as tie-breaker
+            models.Index(
+                fields=['owner', 'timestamp', 'post'],
+                name='timeline_owner_recent'
+            ),
+        ]
+
+    @classmethod
+    def fan_out(cls, posts):
+        """
+        Adds posts to the timelines of their authors' followers, skipping
+        authors with more followers than :func:`fan_out_limit`
+        :param posts: Saved :class:`Post` instances
+        """
+        authors = {post.user_id for post in posts}
+
+        # the followers table links from_user to each of their followers
+        follows = User.followers.through.objects.filter(
+            from_user__in=authors,
+            from_user__follower_total__lte=fan_out_limit(),
+        ).values_list('from_user', 'to_user')
+
+        followers = defaultdict(list)
+        for leader, follower in follows:
+            followers[leader].append(follower)
+
+        cls.objects.bulk_create([
+            cls(owner_id=follower, post=post, timestamp=post.timestamp)
+            for post in posts
+            for follower in followers[post.user_id]
+        ], ignore_conflicts=True)
+
+    @classmethod
+    def follow(cls, follows):
+        """
+        Backfills the most recent posts of newly followed users into their
+        followers' timelines, skipping users with more followers than
+        :func:`fan_out_limit`
+        :param follows: list of (leader id, follower id) pairs
+        """
+        leaders = User.objects.filter(
+            pk__in={leader for leader, _ in follows},
+            follower_total__lte=fan_out_limit(),
+        ).values_list('pk', flat=True)
+
+        recent = dict()
+        for leader in leaders:
+            recent[leader] = Post.objects.filter(
+                user=leader
+            ).order_by('-timestamp').values_list('pk', 'timestamp')[
+                :cls.BACKFILL
+            ]
+
+        cls.objects.bulk_create([
+            cls(owner_id=follower, post_id=post, timestamp=timestamp)
+            for leader, follower in follows if leader in recent
+            for post, timestamp in recent[leader]
+        ], ignore_conflicts=True)
+
+    @classmethod
+    def below_limit(cls, deltas):
+        """
+        Backfills the timelines of every follower of users whose follower
+        count just dropped to :func:`fan_out_limit`, since their posts were
+        left out while they were above it, see :meth:`Timeline.follow`
+        :param deltas: Change in follower count of each user, by id
+        """
+        limit = fan_out_limit()
+        dropped = models.Q()
+        for leader, delta in deltas.items():
+            if delta < 0:
+                dropped |= models.Q(
+                    pk=leader, follower_total__gt=limit + delta
+                )
+        if not dropped:
+            return
+
+        leaders = User.objects.filter(
+            dropped, follower_total__lte=limit
+        ).values('pk')
+        follows = User.followers.through.objects.filter(
+            from_user__in=leaders
+        ).values_list('from_user', 'to_user')
+        cls.follow(list(follows))
+
+    @classmethod
+    def unfollow(cls, unfollows):
+        """
+        Removes posts of unfollowed users from their former followers'
+        timelines
+        :param unfollows: list of (leader id, follower id) pairs
+        """
+        entries = models.Q()
+        for leader, follower in unfollows:
+            entries |= models.Q(owner=follower, post__user=leader)
+
+        cls.objects.filter(entries).delete()
@@ -104,30 +104,14 @@ class Post extends React.Component {
 		var btn = event.target
 		btn.disabled = true
 
-		var data = [{
-			'model': 'post',
-			'id': this.props.data.id,
-			'likes': this.props.selfID
-		}]
-		var mode
-		var newLikeCount
-		if (this.state.iLike) {
-			mode = 'remove'
-			newLikeCount = this.state.likeCount - 1
-		}
-		else {
-			mode = 'add'
-			newLikeCount = this.state.likeCount + 1
-		}
-
-		return fetch('/api/v1/update', {
+		return fetch('/api/v1/like', {
 			method: 'POST',
 			headers: {
 				'X-CSRFTOKEN': self.props.csrfToken
 			},
 			body: JSON.stringify({
-				data: data,
-				multiOption: {'likes': mode}
+				id: this.props.data.id,
+				like: !this.state.iLike
 			})
 		})
 		.then((response) => {
@@ -142,8 +126,8 @@ class Post extends React.Component {
 		.then((payload) => {
 			if (payload) {
 				this.setState((state) => {
-					state.iLike = !state.iLike
-					state.likeCount = newLikeCount
+					state.iLike = payload.i_like
+					state.likeCount = payload.like_count
 					// re-enable button once promise returns and state is set
 					btn.disabled = false
 					return state
@@ -394,14 +378,7 @@ class App extends React.Component {
 	 */
 	whoami = () => {
 
-		const self = this
-
-		fetch('/api/v1/whoami', {
-			method: 'POST',
-			headers: {
-				'X-CSRFTOKEN': self.state.csrfToken
-			}
-		})
+		fetch('/api/v1/whoami')
 		.then(response => response.json())
 		.then((data) => {
 			this.setState((state) => {
@@ -413,7 +390,6 @@ class App extends React.Component {
 	}
 
 	search = (model, fields, filters, order, limit, page, newState) => {
-		const self = this
 
 		// sanitize params
 		if (!model || typeof model != 'string') {
@@ -426,37 +402,58 @@ class App extends React.Component {
 		page = page || 1
 		newState = newState || {}
 
-		return fetch('/api/v1/search', {
+		// searches are sent as GET, so the browser can revalidate
+		// previously downloaded pages by their e-tag
+		const query = JSON.stringify({
+			model: model,
+			order: order,
+			fields: fields,
+			filters: filters,
+			limit: limit,
+			page: page
+		})
+		return fetch(`/api/v1/search?q=${encodeURIComponent(query)}`)
+		// TODO: error handling on response
+		.then(response => response.json())
+		.then(this.receive(model, newState))
+	}
+
+	feed = (fields, limit, page, newState) => {
+
+		// the feed is always newest first, read from the user's timeline
+		// sent as POST, since it depends on who the current user follows
+		return fetch('/api/v1/feed', {
 			method: 'POST',
 			headers: {
-				'X-CSRFTOKEN': self.state.csrfToken
+				'X-CSRFTOKEN': this.state.csrfToken
 			},
 			body: JSON.stringify({
-				model: model,
-				order: order,
-				fields: fields,
-				filters: filters,
-				limit: limit,
-				page: page
+				fields: fields || null,
+				limit: limit || null,
+				page: page || 1
 			})
 		})
-		// TODO: error handling on response
-		// TODO: caching (and maybe e-tags?) to avoid re-downloading data
 		.then(response => response.json())
-		.then((data) => {
-			this.setState((state) => {
-				if (newState.setData || newState.page !== undefined) {
-					if (newState.page !== undefined) {
-						state.page = newState.page
-					}
-					if (newState.setData) {
-						state.inData[model] = data
-					}
+		.then(this.receive('post', newState || {}))
+	}
+
+	/**
+	 * Returns a callback that sets the page and results of a search in app
+	 * state, as requested by newState, and passes the results on
+	 */
+	receive = (model, newState) => (data) => {
+		this.setState((state) => {
+			if (newState.setData || newState.page !== undefined) {
+				if (newState.page !== undefined) {
+					state.page = newState.page
 				}
-				return state
-			})
-			return data
+				if (newState.setData) {
+					state.inData[model] = data
+				}
+			}
+			return state
 		})
+		return data
 	}
 
 	update (data, multiOption, onResponse) {
@@ -505,7 +502,7 @@ class App extends React.Component {
 			return response.json()
 		})
 		.then((payload) => {
-			if (payload) {
+			if (payload && !payload.error) {
 				this.insertNewPost(payload)
 			}
 		})
@@ -567,24 +564,20 @@ class App extends React.Component {
 
 	viewFeed = (event) => {
 
-		// first get everyone the current user is following
-		var username = document.querySelector('#my-profile').dataset.username
-		var filters = [{username: {is: username}}]
-		this.search(
-			'user', [{leaders: ['id']}], filters, null, 1,
-		)
-		.then((payload) => {
-			var userIDs = payload.data.leaders.map(
-				leader => leader.id
-			)
+		// posts by everyone the current user is following
+		this.feed(true, null, 1, {page: 'feed', setData: true})
 
-			filters = [{user: {in: userIDs}}]
-			this.search(
-				'post', true, filters, '-timestamp', null, 1,
-				{page: 'feed', setData: true}
-			)
-		})
+	}
 
+	loadPage = (page) => {
+
+		if (this.state.page === 'feed') {
+			return this.feed(true, null, page, {page: 'feed', setData: true})
+		}
+		return this.search(
+			'post', true, null, '-timestamp', null, page,
+			{page: this.state.page, setData: true}
+		)
 	}
 
 	viewProfile = (event, username) => {
@@ -610,34 +603,21 @@ class App extends React.Component {
 
 	clickedFollowButton = (event) => {
 
-		var data = [{
-			model: 'user',
-			id: this.state.inData.user.data.id,
-			followers: this.state.user.id
-		}]
-
-		var mode
-		if (this.state.inData.user.data.is_following) {
-			mode = 'remove'
-		}
-		else {
-			mode = 'add'
-		}
-
-		var multiOption = {
-			followers: mode
-		}
-
-		this.update(data, multiOption, (data) => {
+		return fetch('/api/v1/follow', {
+			method: 'POST',
+			headers: {
+				'X-CSRFTOKEN': this.state.csrfToken
+			},
+			body: JSON.stringify({
+				id: this.state.inData.user.data.id,
+				follow: !this.state.inData.user.data.is_following
+			})
+		})
+		.then(response => response.json())
+		.then((payload) => {
 			this.setState((state) => {
-				if (mode === 'add') {
-					state.inData.user.data.follower_count += 1
-					state.inData.user.data.is_following = true
-				}
-				else {
-					state.inData.user.data.follower_count -= 1
-					state.inData.user.data.is_following = false
-				}
+				state.inData.user.data.follower_count = payload.follower_count
+				state.inData.user.data.is_following = payload.is_following
 				return state
 			})
 		})
@@ -683,18 +663,10 @@ class App extends React.Component {
 				hasPrevious={this.state.inData.post.hasPrevious}
 				hasNext={this.state.inData.post.hasNext}
 				loadNext={(event) => {
-					this.search(
-						'post', true, null, '-timestamp', null,
-						this.state.inData.post.pageNum + 1,
-						{page: this.state.page, setData: true}
-					)
+					this.loadPage(this.state.inData.post.pageNum + 1)
 				}}
 				loadPrevious={(event) => {
-					this.search(
-						'post', true, null, '-timestamp', null,
-						this.state.inData.post.pageNum - 1,
-						{page: this.state.page, setData: true}
-					)
+					this.loadPage(this.state.inData.post.pageNum - 1)
 				}}
 			/>
 
@@ -1,15 +1,33 @@
+import base64
 import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import pytz
-
-from django.test import TestCase
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import QuerySet
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import AnonymousUser
 
-from .models import User, Post
+from benchmark.graph import generate_graph
+from .management.commands import explain_search
+from .metrics import Registry
+from .models import User, Post, Timeline, like_buffer
 
 
 class ModelTests(TestCase):
 
     def setUp(self):
+        # cached responses outlive the rolled back test database
+        cache.clear()
         self.user = User.objects.create_user('test', password='test')
         self.user.save()
         self.user2 = User.objects.create_user('test2', password='test2')
@@ -127,6 +145,34 @@ class UserTests(ModelTests):
         exp_result = {'id': 1, 'posts': [{'id': 2}, {'id': 1}]}
         self.assertEqual(self.user.serialize(request), exp_result)
 
+    def test_serialize_registered_field_type(self):
+        self.user.last_login = datetime.datetime(
+            2021, 2, 1, 21, 21, 21, tzinfo=pytz.UTC
+        )
+
+        # date times without a custom serializer are converted by field type
+        self.assertEqual(
+            self.user.serialize(['last_login', 'date_joined']),
+            {'last_login': '2021-02-01T21:21:21+00:00',
+             'date_joined': self.user.date_joined.strftime('%c')}
+        )
+
+    def test_compiled_fields_cached(self):
+        request = ['id', {'posts': {'fields': ['id'], 'order': '-id'}}]
+        plan = User.compile_fields(request)
+
+        # equivalent requests share the plan, and plans pass straight through
+        same_request = json.loads(json.dumps(request))
+        self.assertIs(User.compile_fields(same_request), plan)
+        self.assertIs(User.compile_fields(plan), plan)
+        self.assertEqual(
+            self.user.serialize(plan), {'id': 1, 'posts': [{'id': 1}]}
+        )
+
+    def test_compile_fields_validates_nested_order(self):
+        with self.assertRaises(ValueError):
+            User.compile_fields([{'posts': {'fields': ['id'], 'order': 'x'}}])
+
     def test_sort_multi_link_by_invalid_object(self):
         request = ['id', {'posts': None}]
 
@@ -270,6 +316,140 @@ class UserTests(ModelTests):
         self.assertTrue(self.user2 not in self.user.followers.all())
         self.assertTrue(self.user3 in self.user.followers.all())
 
+    def test_update_writes_touched_columns_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.user.update({'model': 'user', 'id': 1, 'followers': 2})
+        writes = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        # only the counter columns changed on the user rows
+        self.assertTrue(all('"first_name"' not in sql for sql in writes))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.user.update({'model': 'user', 'id': 1, 'first_name': 'A'})
+        writes = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(writes), 1)
+        self.assertIn('"first_name"', writes[0])
+        self.assertNotIn('"last_name"', writes[0])
+
+    def test_follow_toggle(self):
+        self.client.force_login(self.user2)
+        response = self.client.post(
+            '/api/v1/follow', json.dumps({'id': 1, 'follow': True}),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.json(), {
+            'model': 'user', 'id': 1, 'is_following': True,
+            'follower_count': 1
+        })
+        self.user.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user.follower_total, 1)
+        self.assertEqual(self.user2.leader_total, 1)
+
+    def test_batch_update_endpoint(self):
+        self.user3 = User.objects.create_user('test3', password='test3')
+        post2 = Post.objects.create(user=self.user, content='Test Post 2')
+        self.client.force_login(self.user)
+
+        data = [
+            {'model': 'post', 'id': 1, 'content': 'Edited'},
+            {'model': 'post', 'id': 2, 'likes': 1},
+            {'model': 'user', 'id': 2, 'followers': 1},
+            {'model': 'user', 'id': 3, 'followers': 1},
+        ]
+        response = self.client.post(
+            '/api/v1/update', json.dumps({
+                'data': data,
+                'multiOption': {'likes': 'add', 'followers': 'add'}
+            }), content_type='application/json'
+        )
+
+        self.assertEqual(response.json(), [
+            {'model': 'post', 'id': 1, 'content': 'Edited'},
+            {'model': 'post', 'id': 2, 'likes': [{'id': 1}]},
+            {'model': 'user', 'id': 2, 'followers': [{'id': 1}]},
+            {'model': 'user', 'id': 3, 'followers': [{'id': 1}]},
+        ])
+        self.post.refresh_from_db()
+        post2.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(self.post.content, 'Edited')
+        self.assertEqual(post2.like_total, 1)
+        self.assertEqual(self.user.leader_total, 2)
+
+    def test_batch_update_rejects_unauthorised_items(self):
+        self.client.force_login(self.user)
+        data = [
+            {'model': 'user', 'id': 1, 'first_name': 'Test'},
+            {'model': 'user', 'id': 2, 'first_name': 'Test'},
+        ]
+        response = self.client.post(
+            '/api/v1/update', json.dumps({'data': data}),
+            content_type='application/json'
+        )
+
+        # nothing is written unless every item is allowed
+        self.assertEqual(response.status_code, 403)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, '')
+
+    def test_user_cannot_edit_own_private_fields(self):
+        self.client.force_login(self.user)
+        for field, value in (('is_staff', True), ('is_superuser', True),
+                             ('password', 'plain'), ('follower_total', 9)):
+            response = self.client.post(
+                '/api/v1/update', json.dumps({'data': [
+                    {'model': 'user', 'id': 1, field: value},
+                ]}), content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 403)
+
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_staff)
+        self.assertFalse(self.user.is_superuser)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_batch_update_string_ids(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            '/api/v1/update', json.dumps({'data': [
+                {'model': 'post', 'id': '1', 'content': 'Edited'},
+            ]}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.content, 'Edited')
+
+        response = self.client.post(
+            '/api/v1/update', json.dumps({'data': [
+                {'model': 'post', 'id': 'first', 'content': 'Edited'},
+            ]}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_links_string_ids(self):
+        # linked ids are matched with the existing links whatever their type
+        for _ in range(2):
+            User.update_links('followers', [(self.user, ['2'], 'set')])
+        self.assertEqual(list(self.user.followers.all()), [self.user2])
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.leader_total, 1)
+
+        with self.assertRaises(ValueError):
+            User.update_links('followers', [(self.user, ['second'], 'add')])
+
+    def test_update_links_locks_both_ends(self):
+        # links are only read once concurrent updates of them have committed
+        with mock.patch.object(
+            QuerySet, 'select_for_update', autospec=True,
+            side_effect=QuerySet.select_for_update
+        ) as select_for_update:
+            Post.update_links('likes', [(self.post, [2], 'add')])
+
+        locked = {call.args[0].model for call in select_for_update.mock_calls}
+        self.assertEqual(locked, {Post, User})
+        self.assertEqual(self.post.likes.get(), self.user2)
+
     def test_parse_equal_filter(self):
 
         filter_ = [{'id': {'is': 1}}]
@@ -310,6 +490,77 @@ class UserTests(ModelTests):
         self.assertEqual(includes, {'id__in': [1, 2, 3]})
         self.assertEqual(excludes, {})
 
+    def test_save_deleted_instance(self):
+        post = Post.objects.get(pk=1)
+        Post.objects.filter(pk=1).delete()
+
+        # saving a deleted instance inserts it again, like a plain save
+        post.content = 'Restored'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=1).content, 'Restored')
+
+    def test_update_maintains_follower_counters(self):
+        self.user3 = User.objects.create_user('test3', password='test3')
+
+        self.user.update(
+            {'model': 'user', 'id': 1, 'followers': [2, 3]}, self.user,
+            {'followers': 'add'}
+        )
+        # adding an existing link doesn't count twice
+        self.user.update(
+            {'model': 'user', 'id': 1, 'followers': 2}, self.user2,
+            {'followers': 'add'}
+        )
+        self.user.update(
+            {'model': 'user', 'id': 1, 'followers': 3}, self.user3,
+            {'followers': 'remove'}
+        )
+
+        self.user.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.user3.refresh_from_db()
+        self.assertEqual(self.user.follower_total, 1)
+        self.assertEqual(self.user2.leader_total, 1)
+        self.assertEqual(self.user3.leader_total, 0)
+
+    def test_save_does_not_overwrite_counters(self):
+        stale = User.objects.get(pk=self.user.pk)
+        self.user.update(
+            {'model': 'user', 'id': 1, 'followers': 2}, self.user2,
+            {'followers': 'set'}
+        )
+        stale.first_name = 'Stale'
+        stale.save()
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.follower_total, 1)
+        self.assertEqual(self.user.first_name, 'Stale')
+
+    @override_settings(NETWORK_COUNTER_COLUMNS=True)
+    def test_summary_reads_counter_column(self):
+        self.user.followers.add(self.user2)
+        self.assertEqual(self.user.follower_count, 0)
+
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.follower_count, 1)
+
+    def test_parse_linked_path_filter(self):
+
+        filter_ = [{'user__followers': {'is': '2'}}]
+        includes, excludes = Post.parse_filters(filter_)
+
+        self.assertEqual(includes, {'user__followers__exact': 2})
+        self.assertEqual(excludes, {})
+
+    def test_parse_invalid_linked_path_filter(self):
+
+        for field in ('user__invalid', 'content__id', 'followers'):
+            with self.assertRaises(ValueError) as e:
+                _ = Post.parse_filters([{field: {'is': 1}}])
+
+            self.assertEqual(str(e.exception), f'invalid field - {field}')
+
 
 class PostTests(ModelTests):
 
@@ -331,6 +582,210 @@ class PostTests(ModelTests):
             )
         )
 
+    def test_like_toggle_idempotent(self):
+        self.client.force_login(self.user2)
+
+        def like(state):
+            return self.client.post(
+                '/api/v1/like', json.dumps({'id': 1, 'like': state}),
+                content_type='application/json'
+            ).json()
+
+        # repeated likes only link (and count) once
+        like(True)
+        self.assertEqual(
+            like(True),
+            {'model': 'post', 'id': 1, 'i_like': True, 'like_count': 1}
+        )
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_total, 1)
+
+        like(False)
+        self.assertEqual(
+            like(False),
+            {'model': 'post', 'id': 1, 'i_like': False, 'like_count': 0}
+        )
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_total, 0)
+
+    def test_toggle_link_duplicate_insert(self):
+        # only the first of two racing inserts changes the link
+        self.assertTrue(Post.toggle_link(1, 'likes', 2))
+        self.assertFalse(Post.toggle_link(1, 'likes', 2))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_total, 1)
+        self.assertEqual(self.post.likes.count(), 1)
+
+    @override_settings(NETWORK_COUNTER_COLUMNS=True)
+    def test_like_toggle_reads_counter(self):
+        Post.objects.filter(pk=1).update(like_total=5)
+        self.client.force_login(self.user2)
+
+        response = self.client.post(
+            '/api/v1/like', json.dumps({'id': 1, 'like': True}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['like_count'], 6)
+
+    def test_like_toggle_invalid_id(self):
+        self.client.force_login(self.user2)
+        for pk in ('first', None, [1]):
+            response = self.client.post(
+                '/api/v1/like', json.dumps({'id': pk, 'like': True}),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(
+        NETWORK_LIKE_BUFFER=True, NETWORK_LINK_BUFFER_INTERVAL=0
+    )
+    def test_buffered_likes(self):
+        self.client.force_login(self.user2)
+        with self.captureOnCommitCallbacks() as callbacks:
+            for state in (True, False, True):
+                response = self.client.post(
+                    '/api/v1/like', json.dumps({'id': 1, 'like': state}),
+                    content_type='application/json'
+                )
+        self.assertEqual(callbacks, [])
+        self.assertEqual(response.json()['like_count'], 1)
+
+        # the user reads their own queued like before it is written
+        self.assertFalse(self.post.likes.exists())
+        self.assertEqual(
+            self.post.serialize(['i_like'], self.user2), {'i_like': True}
+        )
+        self.assertEqual(
+            self.post.serialize(['i_like'], self.user), {'i_like': False}
+        )
+
+        # toggles are coalesced into a single link, bumping generations once
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(self.post.likes.filter(pk=self.user2.pk).exists())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_total, 1)
+
+        # liking again counts the written like once
+        response = self.client.post(
+            '/api/v1/like', json.dumps({'id': 1, 'like': True}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['like_count'], 1)
+        like_buffer.flush()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_total, 1)
+
+    @override_settings(
+        NETWORK_LIKE_BUFFER=True, NETWORK_LINK_BUFFER_INTERVAL=0,
+        NETWORK_SEARCH_CACHE_TIMEOUT=60
+    )
+    def test_buffered_likes_not_hidden_by_cache(self):
+        self.addCleanup(like_buffer.flush)
+        self.client.force_login(self.user2)
+
+        def i_like():
+            return self.client.get('/api/v1/search', {'q': json.dumps({
+                'model': 'post', 'fields': ['id', 'i_like'], 'limit': 1
+            })}).json()['data']['i_like']
+
+        self.assertFalse(i_like())
+        self.client.post(
+            '/api/v1/like', json.dumps({'id': 1, 'like': True}),
+            content_type='application/json'
+        )
+        self.assertTrue(i_like())
+
+    def test_create_posts_in_bulk(self):
+        self.client.force_login(self.user)
+        items = [
+            {'model': 'post', 'content': f'Bulk {i}'} for i in range(3)
+        ]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/v1/create', json.dumps(items),
+                content_type='application/json'
+            )
+        inserts = [q for q in queries if q['sql'].startswith('INSERT')]
+
+        self.assertEqual(
+            [post['content'] for post in response.json()],
+            ['Bulk 0', 'Bulk 1', 'Bulk 2']
+        )
+        self.assertEqual(len(inserts), 1)
+
+    def test_create_rejects_whole_batch(self):
+        self.client.force_login(self.user)
+        items = [
+            {'model': 'post', 'content': 'Valid'},
+            {'model': 'post', 'content': ''},
+        ]
+        response = self.client.post(
+            '/api/v1/create', json.dumps(items),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_create_without_bulk_returned_ids(self):
+        self.client.force_login(self.user)
+        items = [{'model': 'post', 'content': f'Bulk {i}'} for i in range(2)]
+
+        # databases that can't return bulk inserted keys insert each row
+        with mock.patch.object(
+                type(connection.features), 'can_return_rows_from_bulk_insert',
+                new_callable=mock.PropertyMock, return_value=False):
+            response = self.client.post(
+                '/api/v1/create', json.dumps(items),
+                content_type='application/json'
+            )
+
+        self.assertEqual(
+            [post['content'] for post in response.json()],
+            ['Bulk 0', 'Bulk 1']
+        )
+        self.assertEqual(Post.objects.count(), 3)
+
+    def test_create_rejects_non_object_items(self):
+        self.client.force_login(self.user)
+        for data in (['post'], [{'model': 'post', 'content': 'Valid'}, 1]):
+            response = self.client.post(
+                '/api/v1/create', json.dumps(data),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_export_streams_ndjson(self):
+        self.post.likes.add(self.user2)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+
+        response = self.client.get('/api/v1/export', {'kinds': 'posts,likes'})
+        records = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).splitlines()
+        ]
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(
+            [record['model'] for record in records], ['post', 'like']
+        )
+        self.assertEqual(records[1], {'model': 'like', 'post': 1, 'user': 2})
+
+    def test_export_command(self):
+        out = io.StringIO()
+        call_command('export_data', 'users', stdout=out)
+
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record['id'] for record in records], [1, 2])
+        # private fields are not exported
+        self.assertNotIn('password', records[0])
+
     def test_user_cannot_edit_others_likes(self):
 
         with self.assertRaises(PermissionError) as p:
@@ -353,7 +808,763 @@ class PostTests(ModelTests):
         result = self.post.serialize(['i_like', 'id'], self.user2)
         self.assertEqual(result, {'id': 1, 'i_like': True})
 
+    def test_reconcile_counters(self):
+        self.post.likes.add(self.user, self.user2)
+        self.assertEqual(Post.reconcile_counters(), {'like_total': 1})
+        self.assertEqual(Post.reconcile_counters(), {'like_total': 0})
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_total, 2)
+
+    def test_generate_graph(self):
+        sizes = generate_graph(users=20, followers=5, posts=2, likes=3)
+        self.assertEqual(sizes['users'], 20)
+        self.assertEqual(
+            Post.objects.count(), sizes['posts'] + 1
+        )
+        self.assertEqual(
+            Post.likes.through.objects.count(), sizes['likes']
+        )
+
+        # the same seed generates the same graph, and counters are correct
+        self.assertEqual(
+            generate_graph(users=20, followers=5, posts=2, likes=3), sizes
+        )
+        self.assertEqual(User.reconcile_counters(dry_run=True), {
+            'follower_total': 0, 'leader_total': 0
+        })
+
+    def test_feed_searches_use_indexes(self):
+        out = io.StringIO()
+        call_command('explain_search', stdout=out)
+
+        scans = [
+            line for line in out.getvalue().splitlines()
+            if line.startswith('FULL SCAN post')
+        ]
+        self.assertNotIn('FULL SCAN post filters=None order=-timestamp', scans)
+        self.assertNotIn(
+            "FULL SCAN post filters=['user'] order=-timestamp", scans
+        )
+        self.assertIn("FULL SCAN post filters=['content'] order=None", scans)
+
+    def test_explain_search_unsupported_vendor(self):
+        out, err = io.StringIO(), io.StringIO()
+        with mock.patch.dict(explain_search.TABLE_SCANS, clear=True):
+            call_command('explain_search', stdout=out, stderr=err)
+
+        # nothing is reported as a full scan when scans can't be detected
+        self.assertEqual(out.getvalue(), '')
+        self.assertIn('not supported', err.getvalue())
+
     def test_serialize_i_like_negative(self):
 
         result = self.post.serialize(['i_like', 'id'], self.user2)
         self.assertEqual(result, {'id': 1, 'i_like': False})
+
+
+@override_settings(NETWORK_SEARCH_CACHE_TIMEOUT=60)
+class SearchTests(ModelTests):
+
+    def search(self, **query):
+        return self.client.post(
+            '/api/v1/search', json.dumps(query),
+            content_type='application/json'
+        )
+
+    def count_search_queries(self, **query):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search(**query)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_linked_fields_constant_queries(self):
+        query = {
+            'model': 'post',
+            'fields': ['id', 'username', {'user': ['username']},
+                       {'likes': {'fields': ['id'], 'order': '-id'}}],
+        }
+
+        self.post.likes.add(self.user, self.user2)
+        small_page = self.count_search_queries(**query)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(5):
+                post = Post.objects.create(user=self.user2, content=f'P{i}')
+                post.likes.add(self.user)
+        large_page = self.count_search_queries(**query)
+
+        self.assertEqual(small_page, large_page)
+
+    def test_flat_fields_read_as_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search(
+                model='post', fields=['id', 'content', 'user'], order='id'
+            )
+
+        self.assertEqual(response.json()['data'], [
+            {'id': 1, 'content': 'Test Post', 'user': {'id': 1}}
+        ])
+        # only the requested columns are selected
+        self.assertNotIn('"timestamp"', queries[-1]['sql'])
+
+    def test_unrequested_columns_not_loaded(self):
+        query = {
+            'model': 'post', 'order': 'id',
+            'fields': ['id', 'username', {'user': ['username']}],
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search(**query)
+
+        self.assertEqual(response.json()['data'], [
+            {'id': 1, 'username': 'test', 'user': {'username': 'test'}}
+        ])
+        # neither the post content nor the user's password were selected
+        self.assertNotIn('"content"', queries[-1]['sql'])
+        self.assertNotIn('"password"', queries[-1]['sql'])
+
+    def test_search_cached_until_write(self):
+        query = {'model': 'post', 'fields': ['id', 'like_count']}
+        self.count_search_queries(**query)
+
+        # repeated searches are served from cache
+        self.assertEqual(self.count_search_queries(**query), 0)
+
+        # cached responses are read until the write commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.likes.add(self.user2)
+            self.assertEqual(self.count_search_queries(**query), 0)
+        self.assertGreater(self.count_search_queries(**query), 0)
+        self.assertEqual(self.search(**query).json()['data'], [
+            {'id': 1, 'like_count': 1}
+        ])
+
+    def test_null_cursor_cached_separately(self):
+        query = {'model': 'post', 'fields': ['id']}
+        paged = self.search(**query).json()
+        keyset = self.search(**query, cursor=None).json()
+        self.assertIn('pageNum', paged)
+        self.assertIn('nextCursor', keyset)
+
+    def test_contextual_search_cached_per_user(self):
+        self.post.likes.add(self.user2)
+        query = {'model': 'post', 'fields': ['id', 'i_like']}
+
+        self.client.force_login(self.user2)
+        self.assertTrue(self.search(**query).json()['data'][0]['i_like'])
+        self.client.force_login(self.user)
+        self.assertFalse(self.search(**query).json()['data'][0]['i_like'])
+
+    @override_settings(NETWORK_SEARCH_ETAGS=True)
+    def test_get_search_not_modified(self):
+        query = {'q': json.dumps({'model': 'post', 'fields': ['id']})}
+        response = self.client.get('/api/v1/search', query)
+        self.assertEqual(response.json()['data'], [{'id': 1}])
+        etag = response['ETag']
+
+        # unchanged results are answered without a body
+        response = self.client.get(
+            '/api/v1/search', query, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # generations are bumped once the write commits
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.create(user=self.user, content='New Post')
+        response = self.client.get(
+            '/api/v1/search', query, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_search_etag_needs_shared_cache(self):
+        # every process has its own local memory cache, so its own
+        # generations, and could revalidate stale responses
+        query = {'q': json.dumps({'model': 'post', 'fields': ['id']})}
+        response = self.client.get('/api/v1/search', query)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+        dummy = {'default': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache'
+        }}
+        with override_settings(CACHES=dummy):
+            response = self.client.get('/api/v1/search', query)
+        self.assertFalse(response.has_header('ETag'))
+
+    @override_settings(NETWORK_SEARCH_CACHE_TIMEOUT=None)
+    def test_search_not_cached_by_local_cache(self):
+        # other processes wouldn't see writes invalidate a local cache
+        query = {'model': 'post', 'fields': ['id']}
+        self.count_search_queries(**query)
+
+        self.assertGreater(self.count_search_queries(**query), 0)
+
+    def test_search_logged(self):
+        with self.assertLogs('network.requests', 'INFO') as logs:
+            self.search(model='post', fields=['id'])
+            self.search(model='post', fields=['id'])
+
+        first, second = [json.loads(r.getMessage()) for r in logs.records]
+        self.assertEqual(first['view'], 'search')
+        self.assertEqual(first['rows'], 1)
+        self.assertEqual(first['cache'], 'miss')
+        self.assertGreater(first['queries'], 0)
+        self.assertEqual(second['cache'], 'hit')
+        self.assertEqual(second['queries'], 0)
+
+    @override_settings(NETWORK_LOG_SAMPLING={'default': 0})
+    def test_failed_requests_always_logged(self):
+        with self.assertLogs('network.requests', 'INFO') as logs:
+            self.search(model='post', fields=['id'])
+            self.search(model='invalid')
+
+        self.assertEqual(len(logs.records), 1)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['error'], 'model')
+
+    def test_profiled_search(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.post.likes.add(self.user2)
+
+        with self.assertLogs('network.requests', 'INFO') as logs:
+            response = self.client.post(
+                '/api/v1/search', json.dumps({
+                    'model': 'post',
+                    'fields': ['id', 'like_count', {'likes': ['id']}],
+                }), content_type='application/json',
+                HTTP_X_PROFILE_SERIALIZE='1'
+            )
+
+        profile = json.loads(logs.records[0].getMessage())['profile']
+        self.assertEqual(
+            set(profile), {'post.id', 'post.like_count', 'post.likes',
+                           'user.id'}
+        )
+        self.assertEqual(profile['user.id']['calls'], 1)
+        self.assertIn('post.like_count;dur=', response['Server-Timing'])
+
+    @override_settings(NETWORK_LOG_SAMPLING={'default': 0})
+    def test_profile_opt_in_for_staff_only(self):
+        self.client.force_login(self.user)
+        query = {'q': json.dumps({'model': 'post', 'fields': ['id']})}
+
+        # other users' opt ins are ignored
+        with self.assertNoLogs('network.requests', 'INFO'):
+            response = self.client.get(
+                '/api/v1/search', query, HTTP_X_PROFILE_SERIALIZE='1'
+            )
+        self.assertNotIn('Server-Timing', response)
+
+        # cached responses have nothing to time
+        self.user.is_staff = True
+        self.user.save()
+        with self.assertLogs('network.requests', 'INFO') as logs:
+            response = self.client.get(
+                '/api/v1/search', query, HTTP_X_PROFILE_SERIALIZE='1'
+            )
+        self.assertNotIn('Server-Timing', response)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['cache'], 'hit')
+        self.assertEqual(record['profile'], {})
+
+    @override_settings(
+        NETWORK_PROFILE_SERIALIZE=True, NETWORK_LOG_SAMPLING={'default': 0}
+    )
+    def test_profiled_requests_always_logged(self):
+        with self.assertLogs('network.requests', 'INFO') as logs:
+            response = self.search(model='post', fields=['id', 'content'])
+
+        # only staff who opted in get the timings in the response
+        self.assertNotIn('Server-Timing', response)
+        profile = json.loads(logs.records[0].getMessage())['profile']
+        self.assertEqual(set(profile), {'post.id', 'post.content'})
+
+    def test_search_metrics(self):
+        self.search(model='post', fields=['id'])
+        self.search(model='post', filters={'invalid': 1})
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn(
+            'network_request_duration_seconds_bucket{model="post",'
+            'view="search",le="+Inf"}', text
+        )
+        self.assertIn(
+            'network_request_errors_total{error="filters",view="search"}',
+            text
+        )
+        self.assertIn('# TYPE network_field_plans gauge', text)
+
+    @override_settings(NETWORK_METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        for authorization, status in (
+                (None, 403), ('Bearer guess', 403), ('Bearer secret', 200)):
+            headers = {'Authorization': authorization} if authorization else {}
+            response = self.client.get('/metrics', headers=headers)
+            self.assertEqual(response.status_code, status)
+
+    def test_metrics_concurrent_writes(self):
+        registry = Registry()
+        registry.inc('network_requests_total', view='search', status=200)
+        errors = list()
+
+        def write():
+            try:
+                for _ in range(20):
+                    registry.write(force=True)
+            except Exception as e:
+                errors.append(e)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(NETWORK_METRICS_DIR=directory):
+                threads = [threading.Thread(target=write) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                files = os.listdir(directory)
+
+            # a missing directory is logged, not raised
+            with self.settings(NETWORK_METRICS_DIR=f'{directory}/missing'):
+                with self.assertLogs('network.metrics', 'ERROR'):
+                    registry.write(force=True)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(files, [f'{os.getpid()}.json'])
+
+    def test_metrics_aggregated_across_processes(self):
+        registry = Registry()
+        registry.inc('network_requests_total', view='search', status=200)
+        registry.observe(
+            'network_request_duration_seconds', 0.02, view='search'
+        )
+        registry.gauge('network_like_buffer_pending', lambda: 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # a snapshot written by another process, and a stopped one
+            other = registry.snapshot()
+            stopped = dict(other, time=time.time() - 3600)
+            for name, snapshot in (('1.json', other), ('2.json', stopped)):
+                with open(os.path.join(directory, name), 'w') as f:
+                    json.dump(snapshot, f)
+
+            with self.settings(NETWORK_METRICS_DIR=directory):
+                text = registry.exposition()
+
+        self.assertIn(
+            'network_requests_total{status="200",view="search"} 3.0', text
+        )
+        self.assertIn(
+            'network_request_duration_seconds_bucket{view="search",'
+            'le="0.025"} 3', text
+        )
+        self.assertIn(
+            'network_request_duration_seconds_bucket{view="search",'
+            'le="0.01"} 0', text
+        )
+        # gauges of stopped processes are left out
+        self.assertIn('network_like_buffer_pending 4.0', text)
+
+    def test_prefetched_linked_field_order(self):
+        self.post.likes.add(self.user, self.user2)
+
+        response = self.search(
+            model='post', limit=1,
+            fields=[{'likes': {'fields': ['id'], 'order': '-id'}}]
+        )
+        self.assertEqual(
+            response.json()['data'], {'likes': [{'id': 2}, {'id': 1}]}
+        )
+
+    def test_summary_counts_annotated(self):
+        self.post.likes.add(self.user, self.user2)
+        self.user.followers.add(self.user2)
+
+        query = {
+            'model': 'user',
+            'fields': ['id', 'follower_count', 'leader_count',
+                       {'posts': ['id', 'like_count']}],
+            'order': 'id',
+        }
+        small_page = self.count_search_queries(**query)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3, 8):
+                user = User.objects.create_user(f'test{i}', password='test')
+                user.followers.add(self.user, self.user2)
+                self.user.followers.add(user)
+                Post.objects.create(user=user, content='Test').likes.add(user)
+        large_page = self.count_search_queries(**query)
+        self.assertEqual(small_page, large_page)
+
+        data = self.search(**query).json()['data']
+        self.assertEqual(
+            data[0],
+            {'id': 1, 'follower_count': 6, 'leader_count': 5,
+             'posts': [{'id': 1, 'like_count': 2}]}
+        )
+
+    def test_summary_count_falls_back_without_annotation(self):
+        self.post.likes.add(self.user2)
+        self.assertEqual(self.post.like_count, 1)
+
+        post = Post.plan_queryset(Post.objects.all(), ['like_count']).get()
+        self.post.likes.add(self.user)
+        self.assertEqual(post.like_count, 1)
+        self.assertEqual(self.post.like_count, 2)
+
+    def test_prefetched_summary_counts_not_filtered(self):
+        self.user3 = User.objects.create_user('test3', password='test3')
+        self.user.followers.add(self.user2, self.user3)
+
+        response = self.search(
+            model='user', filters=[{'id': {'is': 2}}], limit=1,
+            fields=[{'leaders': ['id', 'follower_count']}]
+        )
+        self.assertEqual(
+            response.json()['data'],
+            {'leaders': [{'id': 1, 'follower_count': 2}]}
+        )
+
+    def test_contextual_fields_constant_queries(self):
+        self.client.force_login(self.user2)
+        self.post.likes.add(self.user2)
+        query = {'model': 'post', 'fields': True, 'order': 'id'}
+        small_page = self.count_search_queries(**query)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(5):
+                post = Post.objects.create(user=self.user, content=f'P{i}')
+                if i % 2:
+                    post.likes.add(self.user2)
+        large_page = self.count_search_queries(**query)
+        self.assertEqual(small_page, large_page)
+
+        data = self.search(**query).json()['data']
+        self.assertEqual(
+            [p['i_like'] for p in data],
+            [True, False, True, False, True, False]
+        )
+
+    def test_nested_contextual_fields_use_request_user(self):
+        self.client.force_login(self.user2)
+        self.user.followers.add(self.user2)
+
+        response = self.search(
+            model='post', limit=1,
+            fields=[{'user': ['id', 'is_following']}]
+        )
+        self.assertEqual(
+            response.json()['data'],
+            {'user': {'id': 1, 'is_following': True}}
+        )
+
+    def test_cursor_pagination(self):
+        # posts sharing a timestamp are ordered by id within it
+        timestamp = datetime.datetime(2021, 2, 1, 21, 21, 21, tzinfo=pytz.UTC)
+        for i in range(4):
+            Post.objects.create(user=self.user, content=f'Post {i}')
+        Post.objects.filter(id__in=[2, 3]).update(timestamp=timestamp)
+        Post.objects.filter(id=1).update(
+            timestamp=timestamp - datetime.timedelta(days=1)
+        )
+
+        query = {'model': 'post', 'fields': ['id'], 'order': '-timestamp',
+                 'limit': 2, 'cursor': None}
+        pages = list()
+        payload = self.search(**query).json()
+        pages.append(payload['data'])
+        self.assertNotIn('pageCount', payload)
+        self.assertIsNone(payload['prevCursor'])
+        while payload['nextCursor']:
+            payload = self.search(**{**query, 'cursor': payload['nextCursor']})
+            payload = payload.json()
+            pages.append(payload['data'])
+
+        self.assertEqual(
+            pages,
+            [[{'id': 5}, {'id': 4}], [{'id': 3}, {'id': 2}], [{'id': 1}]]
+        )
+
+        # and back again from the last page
+        payload = self.search(**{**query, 'cursor': payload['prevCursor']})
+        self.assertEqual(payload.json()['data'], [{'id': 3}, {'id': 2}])
+        self.assertTrue(payload.json()['hasNext'])
+
+    def test_cursor_pagination_without_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.search(model='post', fields=['id'], cursor=None)
+        self.assertFalse(
+            any('COUNT' in q['sql'] for q in queries.captured_queries)
+        )
+
+    def test_invalid_cursor(self):
+        response = self.search(model='post', fields=['id'], cursor='invalid')
+        self.assertEqual(response.status_code, 400)
+
+        # well formed cursors with tampered positions
+        for position in (['-timestamp', 'garbage', 1, False],
+                         ['-timestamp', '2020-01-01T00:00:00', [1], False]):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(position).encode()
+            ).decode()
+            response = self.search(
+                model='post', fields=['id'], order='-timestamp',
+                cursor=cursor
+            )
+            self.assertEqual(response.status_code, 400)
+
+    def test_multi_link_filters_distinct(self):
+        self.user3 = User.objects.create_user('test3', password='test3')
+        self.user.followers.add(self.user2, self.user3)
+
+        # the post's user is followed by both, but it is only returned once
+        response = self.search(
+            model='post', fields=['id'], cursor=None, limit=5,
+            filters=[{'user__followers': {'in': [2, 3]}}]
+        )
+        self.assertEqual(response.json()['data'], [{'id': 1}])
+        response = self.search(
+            model='post', fields=['id'],
+            filters=[{'user__followers': {'in': [2, 3]}}]
+        )
+        self.assertEqual(response.json()['data'], [{'id': 1}])
+        self.assertEqual(response.json()['pageCount'], 1)
+
+        # a single follower can only match once, so no distinct is needed
+        self.assertFalse(
+            Post.filters_fan_out({'user__followers__exact': 2})
+        )
+
+    def test_empty_single_result(self):
+        response = self.search(
+            model='post', fields=['id'], limit=1, cursor=None,
+            filters=[{'content': {'is': 'Missing'}}]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['data'])
+
+    def test_following_feed_single_query(self):
+        self.user3 = User.objects.create_user('test3', password='test3')
+        Post.objects.create(user=self.user2, content='Not followed')
+        Post.objects.create(user=self.user3, content='Followed')
+        self.user3.followers.add(self.user2)
+        self.user.followers.add(self.user2)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search(
+                model='post', fields=['id'], order='-timestamp', cursor=None,
+                filters=[{'user__followers': {'is': self.user2.id}}]
+            )
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.json()['data'], [{'id': 3}, {'id': 1}])
+
+
+@override_settings(NETWORK_TIMELINE=True)
+class TimelineTests(ModelTests):
+
+    def feed(self, **query):
+        return self.client.post(
+            '/api/v1/feed', json.dumps({'fields': ['id'], **query}),
+            content_type='application/json'
+        )
+
+    def follow(self, leader, follower, mode='add'):
+        leader.update(
+            {'model': 'user', 'id': leader.id, 'followers': follower.id},
+            follower, {'followers': mode}
+        )
+
+    def test_follow_backfills_timeline(self):
+        self.follow(self.user, self.user2)
+
+        self.assertEqual(
+            list(Timeline.objects.values_list('owner', 'post')), [(2, 1)]
+        )
+
+    def test_unfollow_clears_timeline(self):
+        self.follow(self.user, self.user2)
+        self.follow(self.user, self.user2, 'remove')
+
+        self.assertFalse(Timeline.objects.exists())
+
+    def test_create_fans_out_post(self):
+        self.follow(self.user2, self.user)
+        self.client.force_login(self.user2)
+        self.client.post(
+            '/api/v1/create', json.dumps({'model': 'post', 'content': 'Hi'}),
+            content_type='application/json'
+        )
+
+        self.assertTrue(Timeline.objects.filter(owner=self.user).exists())
+
+    def test_feed_merges_popular_users(self):
+        self.follow(self.user, self.user2)
+        self.user3 = User.objects.create_user('test3', password='test3')
+        Post.objects.create(user=self.user3, content='Popular Post')
+
+        with self.settings(NETWORK_TIMELINE_FAN_OUT_LIMIT=0):
+            self.follow(self.user3, self.user2)
+            self.assertFalse(Timeline.objects.filter(post=2).exists())
+
+            self.client.force_login(self.user2)
+            response = self.feed()
+
+        self.assertEqual(response.json()['data'], [{'id': 2}, {'id': 1}])
+
+    def test_feed_backfills_users_dropping_below_limit(self):
+        self.user3 = User.objects.create_user('test3', password='test3')
+        Post.objects.create(user=self.user3, content='Popular Post')
+
+        with self.settings(NETWORK_TIMELINE_FAN_OUT_LIMIT=1):
+            self.follow(self.user3, self.user)
+            self.follow(self.user3, self.user2)
+            self.assertFalse(Timeline.objects.filter(owner=self.user2))
+
+            self.follow(self.user3, self.user, 'remove')
+            self.client.force_login(self.user2)
+            response = self.feed()
+
+        self.assertEqual(response.json()['data'], [{'id': 2}])
+
+    def test_feed_ordered_by_timeline(self):
+        self.follow(self.user, self.user2)
+        Post.objects.create(user=self.user, content='Newer Post')
+        Timeline.fan_out(list(Post.objects.filter(pk=2)))
+        self.client.force_login(self.user2)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.feed()
+
+        self.assertEqual(response.json()['data'], [{'id': 2}, {'id': 1}])
+        self.assertTrue(any(
+            '"network_timeline"."timestamp" DESC' in query['sql']
+            for query in queries
+        ))
+
+    def test_feed_requires_json_object(self):
+        self.client.force_login(self.user2)
+        response = self.client.post(
+            '/api/v1/feed', '[1]', content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_feed_rejects_cursor(self):
+        self.client.force_login(self.user2)
+
+        self.assertEqual(self.feed(cursor=None).status_code, 400)
+        self.assertEqual(self.feed(order='content').status_code, 400)
+
+
+class QueryCountTests(TestCase):
+    """
+    Canonical requests run the same number of queries whatever the size of
+    the graph and of the page or batch, so an N+1 query fails here.
+    """
+
+    # seeded graphs of increasing size, as (users, followers, posts, likes)
+    GRAPHS = ((10, 3, 3, 3), (60, 15, 4, 10))
+
+    # page sizes of searches and batch sizes of updates
+    SIZES = (2, 10)
+
+    PROFILE_FIELDS = [
+        'username', 'follower_count', 'leader_count', 'can_follow',
+        'is_following', 'is_self', 'id', {'leaders': ['id']}
+    ]
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, **query):
+        return self.client.get('/api/v1/search', {'q': json.dumps(query)})
+
+    def update(self, data, multi_option=None):
+        return self.client.post(
+            '/api/v1/update', json.dumps({
+                'data': data, 'multiOption': multi_option
+            }), content_type='application/json'
+        )
+
+    def assertConstantQueries(self, send):
+        """
+        Sends a request for each size in SIZES, on each graph in GRAPHS, and
+        asserts they all run as many queries as the first
+        :param send: callable taking the logged in user and size, that sends
+                     the request and returns the response
+        """
+        expected = None
+        for graph in self.GRAPHS:
+            generate_graph(*graph)
+            user = User.objects.order_by('-leader_total', 'pk').first()
+            # enough posts of their own to edit a batch of any size
+            Post.objects.bulk_create([
+                Post(user=user, content='Query count')
+                for _ in range(max(self.SIZES))
+            ])
+            self.client.force_login(user)
+
+            for size in self.SIZES:
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    response = send(user, size)
+                self.assertEqual(response.status_code, 200, response.content)
+
+                sql = [query['sql'] for query in queries]
+                if expected is None:
+                    expected = (graph, size, sql)
+                elif len(sql) != len(expected[2]):
+                    self.fail('\n'.join([
+                        f'{len(sql)} queries with graph {graph} and size '
+                        f'{size}, expected {len(expected[2])} as with graph '
+                        f'{expected[0]} and size {expected[1]}',
+                        'Expected:', *expected[2], 'Captured:', *sql,
+                    ]))
+
+    def test_search_posts(self):
+        self.assertConstantQueries(lambda user, size: self.search(
+            model='post', fields=True, order='-timestamp', limit=size,
+            page=1
+        ))
+
+    def test_search_feed(self):
+        self.assertConstantQueries(lambda user, size: self.search(
+            model='post', fields=True, order='-timestamp', limit=size,
+            page=1, filters=[{'user__followers': {'is': user.pk}}]
+        ))
+
+    def test_search_users(self):
+        self.assertConstantQueries(lambda user, size: self.search(
+            model='user', fields=self.PROFILE_FIELDS, order='id',
+            limit=size, page=1
+        ))
+
+    def test_search_linked_likes(self):
+        self.assertConstantQueries(lambda user, size: self.search(
+            model='post', order='id', limit=size, page=1, fields=[
+                'id', 'username', {'user': ['username', 'follower_count']},
+                {'likes': {'fields': ['id', 'is_following'],
+                           'order': '-id'}},
+            ]
+        ))
+
+    def test_update_contents(self):
+        self.assertConstantQueries(lambda user, size: self.update([
+            {'model': 'post', 'id': pk, 'content': 'Edited'}
+            for pk in user.posts.values_list('pk', flat=True)[:size]
+        ]))
+
+    def test_update_likes(self):
+        self.assertConstantQueries(lambda user, size: self.update([
+            {'model': 'post', 'id': pk, 'likes': user.pk}
+            for pk in Post.objects.values_list('pk', flat=True)[:size]
+        ], {'likes': 'add'}))
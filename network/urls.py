@@ -12,6 +12,11 @@ urlpatterns = [
     # API Routes
     path('api/v1/whoami', views.whoami, name='whoami'),
     path('api/v1/search', views.search, name='search'),
+    path('api/v1/feed', views.feed, name='feed'),
     path('api/v1/update', views.update, name='update'),
+    path('api/v1/like', views.like, name='like'),
+    path('api/v1/follow', views.follow, name='follow'),
     path('api/v1/create', views.create, name='create'),
+    path('api/v1/export', views.export, name='export'),
+    path('metrics', views.metrics, name='metrics'),
 ]
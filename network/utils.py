@@ -1,10 +1,67 @@
+import atexit
+import base64
+import binascii
+import contextlib
+import contextvars
+import hashlib
+import itertools
 import json
-
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import (
+    Count,
+    Exists,
+    F,
+    OuterRef,
+    Prefetch,
+    Q,
+    Subquery,
+)
+from django.db.models.functions import Coalesce
 from django.db.models.fields.related import RelatedField, ForeignObjectRel
 from django.db.models.manager import Manager
-from django.db.models.fields import IntegerField
-from django.core.exceptions import FieldDoesNotExist
-
+from django.db.models.fields import (
+    DateField,
+    DecimalField,
+    DurationField,
+    IntegerField,
+    TimeField,
+    UUIDField,
+)
+from django.db.models.signals import (
+    class_prepared,
+    m2m_changed,
+    post_delete,
+    post_save,
+)
+from django.dispatch import receiver
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+
+
+logger = logging.getLogger(__name__)
+
+ANNOTATION_EXTENSION = '__annotated'
+
+# converters from raw field values to json, keyed by django field class
+SERIALIZERS = dict()
+
+# search query keys that determine the response
+SEARCH_KEYS = (
+    'model', 'filters', 'order', 'fields', 'limit', 'page', 'cursor'
+)
+
+# seconds search responses are cached for by default, with a shared cache
+SEARCH_CACHE_TIMEOUT = 60
 
 OPERATORS = {
     # TODO: refactor operators as class
@@ -25,7 +82,7 @@ def convert_filter_value_by_data_type(field, value):
     """
 
     is_int = isinstance(field, IntegerField)
-    is_int_like = isinstance(field, RelatedField)
+    is_int_like = isinstance(field, (RelatedField, ForeignObjectRel))
     if is_int or is_int_like:
         value = int(value)
 
@@ -39,17 +96,655 @@ def sanitize_update_request(request, multi_option):
     return request, multi_option
 
 
+def use_counters():
+    """
+    Whether summary fields backed by a counter column should read it, rather
+    than counting the relation. Enabled by the NETWORK_COUNTER_COLUMNS
+    setting. Counter columns are maintained on every write regardless.
+    :rtype: bool
+    """
+    return getattr(settings, 'NETWORK_COUNTER_COLUMNS', False)
+
+
+def shared_cache():
+    """
+    Whether the default cache is shared by every process, so generation
+    counters kept in it are the same wherever a request is served. Local
+    memory and dummy caches aren't.
+    :rtype: bool
+    """
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+def search_cache_timeout():
+    """
+    Seconds search responses are cached for, as set by the
+    NETWORK_SEARCH_CACHE_TIMEOUT setting. Caching is disabled if falsy. If
+    None, responses are cached for SEARCH_CACHE_TIMEOUT seconds only when
+    the cache is shared, since a write in one process can't invalidate the
+    responses cached by another.
+    :rtype: int
+    """
+    timeout = getattr(settings, 'NETWORK_SEARCH_CACHE_TIMEOUT', None)
+    if timeout is None:
+        return SEARCH_CACHE_TIMEOUT if shared_cache() else 0
+    return timeout
+
+
+def use_search_etags():
+    """
+    Whether search responses get ETags, as set by the NETWORK_SEARCH_ETAGS
+    setting. ETags are digests of the generation counters, so are only valid
+    while every process reads the same counters. If None, ETags are used
+    unless the default cache is local to each process or a dummy cache.
+    :rtype: bool
+    """
+    enabled = getattr(settings, 'NETWORK_SEARCH_ETAGS', None)
+    if enabled is None:
+        return shared_cache()
+    return enabled
+
+
+def use_like_buffer():
+    """
+    Whether like toggles are queued in a write-behind :class:`LinkBuffer`
+    and applied in bulk, rather than written by each request. Enabled by the
+    NETWORK_LIKE_BUFFER setting.
+    :rtype: bool
+    """
+    return getattr(settings, 'NETWORK_LIKE_BUFFER', False)
+
+
+def link_buffer_interval():
+    """
+    Seconds between background flushes of link buffers, as set by the
+    NETWORK_LINK_BUFFER_INTERVAL setting. If falsy, buffers are only flushed
+    when :meth:`LinkBuffer.flush` is called.
+    :rtype: float
+    """
+    return getattr(settings, 'NETWORK_LINK_BUFFER_INTERVAL', 1.0)
+
+
+def profile_serialize():
+    """
+    Whether the time spent serializing each field is profiled on every
+    request, see :class:`SerializeProfile`. Enabled by the
+    NETWORK_PROFILE_SERIALIZE setting, otherwise staff users opt in with the
+    X-Profile-Serialize header.
+    :rtype: bool
+    """
+    return getattr(settings, 'NETWORK_PROFILE_SERIALIZE', False)
+
+
+# profile collecting field timings in the current context, if any
+active_profile = contextvars.ContextVar('active_profile', default=None)
+
+
+class SerializeProfile(object):
+    """
+    Time spent resolving each field while serializing models, by model and
+    field name. Used as a context manager, it profiles every serialization
+    within it. Timings of linked fields include serializing the linked
+    models, whose own fields are also profiled.
+    """
+
+    def __init__(self):
+        # calls and total seconds, keyed by (model name, field name)
+        self.fields = defaultdict(lambda: [0, 0.0])
+        self._token = None
+
+    def __enter__(self):
+        self._token = active_profile.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        active_profile.reset(self._token)
+
+    def add(self, model, field, duration):
+        """
+        Records the time taken to resolve a field
+        :param model: Model class the field was serialized from
+        :param field: Name of the field
+        :param duration: Seconds taken
+        """
+        timing = self.fields[(model._meta.model_name, field)]
+        timing[0] += 1
+        timing[1] += duration
+
+    def breakdown(self):
+        """
+        Calls and total milliseconds of each field, slowest first
+        :return: dict keyed by model.field
+        :rtype: dict
+        """
+        timings = sorted(
+            self.fields.items(), key=lambda item: item[1][1], reverse=True
+        )
+        return {
+            f'{model}.{field}': {
+                'calls': calls, 'ms': round(seconds * 1000, 3)
+            }
+            for (model, field), (calls, seconds) in timings
+        }
+
+
+def generation_key(model):
+    """Cache key of the generation counter of a model class"""
+    return f'network:generation:{model._meta.label_lower}'
+
+
+def bump_generation(*models):
+    """
+    Increments the generation counters of model classes, so responses cached
+    under the previous generations are no longer read. Deferred until the
+    current transaction commits, otherwise a concurrent search could cache
+    the rows from before the commit under the new generations.
+    :param models: Model classes that were written to
+    """
+    transaction.on_commit(lambda: increment_generations(models))
+
+
+def increment_generations(models):
+    """
+    Increments the generation counters of model classes straight away, see
+    :func:`bump_generation`.
+    :param models: Model classes that were written to
+    """
+    for model in models:
+        increment_counter(generation_key(model))
+
+
+def increment_counter(key):
+    """Increments a generation counter in the cache, seeding it if unset"""
+    try:
+        cache.incr(key)
+    except ValueError:
+        # counter not set yet, or evicted
+        if not cache.add(key, generation_seed(), timeout=None):
+            cache.incr(key)
+
+
+def context_key(context):
+    """Cache key of the generation counter of a user's contextual fields"""
+    return f'network:generation:context:{context.pk}'
+
+
+def bump_context(context):
+    """
+    Increments the generation counter of a user's contextual fields straight
+    away, so responses cached for them are no longer read. Used when links
+    the user sees before they are written are queued in a
+    :class:`LinkBuffer`, which no transaction commits.
+    :param context: User whose contextual fields changed
+    """
+    increment_counter(context_key(context))
+
+
+def generation_seed():
+    """
+    Initial value of a generation counter, from the current time, so a
+    counter evicted from the cache never repeats an earlier generation.
+    :rtype: int
+    """
+    return time.time_ns() // 1000
+
+
+def model_generations(context=None):
+    """
+    Current generation of every model extended by :class:`ModelExtension`,
+    since search results can read any of them through linked fields and
+    filters.
+    :param context: User whose contextual fields' generation is included,
+                    if any
+    :rtype: tuple[int]
+    """
+    models = [
+        model for model in apps.get_app_config('network').get_models()
+        if issubclass(model, ModelExtension)
+    ]
+    keys = [generation_key(model) for model in models]
+    if context is not None:
+        keys.append(context_key(context))
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, generation_seed(), timeout=None)
+            generations[key] = cache.get(key)
+
+    return tuple(generations[key] for key in keys)
+
+
+def search_digest(query, model, context):
+    """
+    Digest of a search response, from the normalized query and the current
+    generation of each model, so it changes whenever the response could.
+    Results with contextual fields are digested for each user (or anonymous
+    users) separately, with the generation of the user's contextual fields.
+    Used as the response cache key and ETag.
+    :param query: Parsed search query
+    :param model: Model class searched
+    :param context: User making the request
+    :return: hex digest, or None if the requested fields can't be compiled
+    :rtype: str
+    """
+    try:
+        contextual = model.compile_fields(query.get('fields')).is_contextual
+    except ValueError:
+        return
+
+    # absent keys are left out, a null cursor pages unlike a missing one
+    normalized = {key: query[key] for key in SEARCH_KEYS if key in query}
+    normalized['model'] = model._meta.label_lower
+    normalized['context'] = context.pk if contextual else None
+    normalized['generations'] = model_generations(
+        context if contextual and context.is_authenticated else None
+    )
+
+    return hashlib.sha256(
+        json.dumps(normalized, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def encode_cursor(order, value, pk, backwards=False):
+    """
+    Creates an opaque cursor pointing at a row in an ordered result set.
+    :param order: Order the result set was sorted by
+    :param value: Value of the order field on the row, as a string
+    :param pk: Primary key of the row, to break ties in the order field
+    :param backwards: True if the cursor pages towards the start of the set
+    :rtype: str
+    """
+    position = json.dumps([order, value, pk, backwards])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Unpacks a cursor created by :func:`encode_cursor`
+    :param cursor: Opaque cursor string
+    :raises: ValueError if cursor cannot be decoded
+    :return: order, value, pk, backwards
+    :rtype: tuple
+    """
+    try:
+        order, value, pk, backwards = json.loads(
+            base64.urlsafe_b64decode(cursor.encode())
+        )
+    except (AttributeError, TypeError, ValueError, binascii.Error):
+        raise ValueError(f'could not decode cursor {cursor}')
+
+    return order, value, pk, backwards
+
+
 def field_label():
+    """
+    Creates a decorator that groups properties under a common label.
+    The decorator can be applied bare, or called with keyword options that
+    are stored against the property name, e.g.
+        @summary(depends=('user__username', ))
+    Supported options:
+        depends -> field paths read by the property, relations on the path
+                   will be loaded alongside the model by the query planner.
+                   Columns are pruned to those requested, so properties
+                   must declare any other columns they read.
+        aggregate -> expression that computes the property in the database,
+                     annotated onto querysets by the query planner. The
+                     property falls back to its own implementation for
+                     instances that were not loaded with the annotation.
+        membership -> name of a multi-link field the property checks the
+                      context for. The query planner fetches the links to
+                      the context for a whole page in one query, and the
+                      property falls back to its own implementation for
+                      instances that were not planned.
+        counter -> tuple of multi-link field and the column on the current
+                   model that persists its count. The column is kept in sync
+                   by :meth:`ModelExtension.update`, and read by the property
+                   when :func:`use_counters` is enabled.
+        buffer -> :class:`LinkBuffer` of links to the context the property
+                  checks. Links queued for the context take precedence, so
+                  users read their own buffered writes.
+    """
     labels = set()
+    options = dict()
+
+    def label(func=None, **kwargs):
+        if func is None:
+            return functools.partial(label, **kwargs)
 
-    def label(func):
         labels.add(func.__name__)
+        options[func.__name__] = kwargs
+
+        if 'aggregate' in kwargs:
+            func = annotated(func)
+        if 'membership' in kwargs:
+            func = context_member(func)
+        if 'counter' in kwargs:
+            func = counted(func, kwargs['counter'][1])
+        if 'buffer' in kwargs:
+            func = buffered(func, kwargs['buffer'])
         return func
 
     label.all = labels
+    label.options = options
     return label
 
 
+def annotated(func):
+    """
+    Wraps a property getter to prefer a value annotated onto the instance by
+    the query planner, as named by :func:`annotation_name`.
+    """
+    name = annotation_name(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(self):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            return func(self)
+
+    return wrapper
+
+
+def counted(func, column):
+    """
+    Wraps a property getter to read its counter column instead, when
+    :func:`use_counters` is enabled.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self):
+        if use_counters():
+            return getattr(self, column)
+        return func(self)
+
+    return wrapper
+
+
+def context_member(func):
+    """
+    Wraps a property getter to prefer the links to the context prefetched
+    onto the instance by the query planner, as named by
+    :func:`context_name`.
+    """
+    name = context_name(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(self):
+        try:
+            return bool(getattr(self, name))
+        except AttributeError:
+            return func(self)
+
+    return wrapper
+
+
+def buffered(func, buffer):
+    """
+    Wraps a contextual property getter to prefer the state of the link
+    between the instance and the context queued in a :class:`LinkBuffer`.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self):
+        context = self._context
+        if context is not None and context.is_authenticated:
+            linked = buffer.pending(self.pk, context.pk)
+            if linked is not None:
+                return linked
+        return func(self)
+
+    return wrapper
+
+
+class LinkBuffer(object):
+    """
+    Write-behind buffer of links to toggle on a many-to-many field.
+    Toggles are coalesced per pair of linked models, keeping the latest
+    state, and applied in bulk by a background thread every
+    :func:`link_buffer_interval` seconds, on exit, or when
+    :meth:`LinkBuffer.flush` is called.
+    """
+
+    def __init__(self, model, field):
+        """
+        :param model: Label of the model with the field, e.g. 'network.Post'
+        :param field: Name of many-to-many field on the model
+        """
+        self.model = model
+        self.field = field
+        self._pending = dict()
+        self._flushing = dict()
+        self._lock = threading.Lock()
+        # the background thread, exit handler and callers may all flush
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, pk, value, linked):
+        """
+        Queues a link to be added or removed on the next flush
+        :param pk: Primary key of the model with the field
+        :param value: Primary key of the model to link or unlink
+        :param linked: True to link, False to unlink
+        """
+        with self._lock:
+            self._pending[(pk, value)] = linked
+        self.start()
+
+    def size(self):
+        """
+        Number of links queued or being flushed
+        :rtype: int
+        """
+        return len(self._pending) + len(self._flushing)
+
+    def pending(self, pk, value):
+        """
+        Queued state of a link that has not been written yet
+        :return: True if linked, False if unlinked or None if not queued
+        """
+        linked = self._pending.get((pk, value))
+        if linked is None:
+            linked = self._flushing.get((pk, value))
+        return linked
+
+    def flush(self):
+        """
+        Writes queued links in bulk, with a single insert and delete on the
+        through table, see :meth:`ModelExtension.update_links`. Only one
+        flush runs at a time, others wait for it to finish.
+        :return: Number of links flushed
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                # keep serving read-your-writes until the links are written
+                batch, self._pending = self._pending, dict()
+                self._flushing = batch
+            if not batch:
+                return 0
+
+            model = apps.get_model(self.model)
+            changes = defaultdict(list)
+            for (pk, value), linked in batch.items():
+                changes[(pk, 'add' if linked else 'remove')].append(value)
+
+            try:
+                with transaction.atomic():
+                    model.update_links(self.field, [
+                        (model(pk=pk), ids, mode)
+                        for (pk, mode), ids in changes.items()
+                    ])
+            except Exception:
+                # requeue links that weren't toggled again in the meantime
+                with self._lock:
+                    self._pending = {**batch, **self._pending}
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = dict()
+
+            return len(batch)
+
+    def start(self):
+        """Starts the background flusher, unless already running"""
+        if self._thread is not None or not link_buffer_interval():
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run, name=f'{self.model}.{self.field} buffer',
+                    daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(link_buffer_interval() or 1.0)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(f'Failed to flush {self.model}.{self.field}')
+            finally:
+                # the thread's connection would otherwise stay open
+                connection.close()
+
+
+def context_name(field):
+    """
+    Attribute under which the query planner prefetches links between an
+    instance and the context for a contextual membership field.
+    """
+    return f'_{field}_context'
+
+
+def annotation_name(field):
+    """
+    Name under which an aggregate field is annotated onto a queryset, kept
+    distinct from the property name so the two don't clash.
+    """
+    return f'{field}{ANNOTATION_EXTENSION}'
+
+
+def serializer(*field_classes):
+    """
+    Registers the decorated function as the converter of raw values for the
+    given django field classes, and their subclasses, into json
+    serializable values.
+    """
+    def register(func):
+        for field_class in field_classes:
+            SERIALIZERS[field_class] = func
+        return func
+
+    return register
+
+
+@serializer(DateField, TimeField)
+def serialize_isoformat(value):
+    return value.isoformat()
+
+
+@serializer(DecimalField, UUIDField)
+def serialize_str(value):
+    return str(value)
+
+
+@serializer(DurationField)
+def serialize_duration(value):
+    return value.total_seconds()
+
+
+def resolve_serializer(model, name):
+    """
+    Resolves how values of a serializable field on model are converted into
+    json serializable values. A property named with the model's
+    :attr:`ModelExtension.SERIAL_EXTENSION` takes precedence over the
+    converter registered for the field class.
+    :param model: Model class the field is on
+    :param name: Name of the field
+    :return: function taking the instance and the raw (not None) value, or
+             None if raw values are already json serializable
+    """
+    serial_name = f'{name}{model.SERIAL_EXTENSION}'
+    if hasattr(model, serial_name):
+        return lambda instance, value: getattr(instance, serial_name)
+
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return
+
+    for field_class in type(field).__mro__:
+        if field_class in SERIALIZERS:
+            convert = SERIALIZERS[field_class]
+            return lambda instance, value: convert(value)
+
+
+class FieldPlan(
+    namedtuple('FieldPlan', ['model', 'fields', 'linked', 'columns'])
+):
+    """
+    Requested fields compiled by :meth:`ModelExtension.compile_fields`, so
+    they can be serialized from each instance without further validation.
+        model -> model class the fields were requested from
+        fields -> tuple of :class:`DirectField` on the model
+        linked -> tuple of :class:`LinkedField` to serialize linked models
+        columns -> tuple of attnames the fields can be serialized from
+                   with a values() query, or None if they need models
+    """
+    __slots__ = ()
+
+    @property
+    def is_contextual(self):
+        """Whether any field, including on linked models, is contextual"""
+        contextual = self.model.contextual_fields()
+        return (
+            any(field.name in contextual for field in self.fields) or
+            any(link.plan.is_contextual for link in self.linked)
+        )
+
+
+class DirectField(
+    namedtuple('DirectField', ['name', 'attname', 'is_link', 'serializer'])
+):
+    """
+    Compiled direct field.
+        name -> field name, as requested
+        attname -> attribute holding the raw value on an instance
+        is_link -> True for foreign keys, serialized as the linked id
+        serializer -> converter from :func:`resolve_serializer`, or None
+    """
+    __slots__ = ()
+
+
+class LinkedField(
+    namedtuple('LinkedField', ['name', 'is_multi', 'order', 'plan'])
+):
+    """
+    Compiled linked field.
+        name -> field name, as requested
+        is_multi -> True for multi-links, serialized as a list
+        order -> order of multi-link values, or None
+        plan -> :class:`FieldPlan` of fields requested on the linked model
+    """
+    __slots__ = ()
+
+
+@functools.lru_cache(maxsize=256)
+def cached_field_plan(model, request_json):
+    """
+    Compiles requested fields on model, caching the plan by the canonical
+    json of the request.
+    :param model: Model class the fields are requested from
+    :param request_json: Requested fields, as json with sorted keys
+    :rtype: FieldPlan
+    """
+    return model.build_field_plan(json.loads(request_json))
+
+
 class ModelExtension(object):
     """
     Extension for :class:`Model` to provide additional functionality, such as
@@ -62,6 +757,10 @@ class ModelExtension(object):
     contextual = field_label()
     _context = None
 
+    # serializable fields that need converting to json, mapped to their
+    # converter, resolved once when the model class is prepared
+    field_serializers = dict()
+
     def set_context(self, context):
         self._context = context
 
@@ -107,6 +806,35 @@ class ModelExtension(object):
         """Pass-through to be overloaded by subclasses"""
         return context
 
+    @classmethod
+    def on_created(cls, instances):
+        """
+        Pass-through to be overloaded by subclasses, called with new instances
+        after they are saved by the create api.
+        """
+        pass
+
+    @classmethod
+    def create_batch(cls, instances):
+        """
+        Saves new instances of the current class with a single bulk insert,
+        then passes them to :meth:`ModelExtension.on_created`. Databases
+        that can't return the primary keys of bulk inserted rows get one
+        insert per instance instead.
+        :param instances: new, unsaved instances of the current class
+        :return: the saved instances
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            instances = cls.objects.bulk_create(instances)
+        else:
+            for instance in instances:
+                instance.save(force_insert=True)
+        cls.on_created(instances)
+        # bulk inserts don't send the signals that bump generations
+        bump_generation(cls)
+
+        return instances
+
     @classmethod
     def sanitize_return_fields(cls, request_fields):
         """
@@ -149,6 +877,9 @@ class ModelExtension(object):
                                 sub_field_class,
                                 (RelatedField, ForeignObjectRel)
                             )
+                            assert issubclass(
+                                sub_field_class.related_model, ModelExtension
+                            )
                         except (FieldDoesNotExist, AssertionError):
                             raise ValueError(
                                 f'{sub_field} is not a linked field of {cls}'
@@ -174,6 +905,468 @@ class ModelExtension(object):
 
         return fields, linked_fields
 
+    @classmethod
+    def sanitize_multi_link_options(cls, options):
+        """
+        Splits options requested on a multi-link field into sub fields and
+        sort order.
+        :param options: List of fields, dict of options in format
+                        {'fields': <fields>, 'order': <field>}, or
+                        :attr:`ModelExtension.SELECT_ALL`
+        :raises: ValueError if options badly formatted
+        :return: requested fields, and order (or None if not provided)
+        """
+        # extract values from multi-link field, if any
+        if isinstance(options, dict):
+            return options.get('fields'), options.get('order')
+        # assume list of fields if no options given
+        elif isinstance(options, list):
+            return options, None
+        # bail out if input recognised
+        elif options == cls.SELECT_ALL:
+            return options, None
+        else:
+            raise ValueError(
+                f'multi-link field expects fields as list, '
+                f'options as dict, or {cls.SELECT_ALL} '
+                f'- got {type(options)}'
+            )
+
+    @classmethod
+    def compile_fields(cls, request_fields):
+        """
+        Compiles requested fields into an immutable plan, which serializes
+        every instance without validating the request again. Plans are cached
+        by request, so repeated requests are only compiled once.
+        :param request_fields: Fields requested to return with the query, in
+                               the same format as
+                               :meth:`ModelExtension.sanitize_return_fields`,
+                               or an already compiled :class:`FieldPlan`
+        :raises: ValueError if request fields badly formatted.
+        :rtype: FieldPlan
+        """
+        if isinstance(request_fields, FieldPlan):
+            return request_fields
+
+        try:
+            request_json = json.dumps(request_fields, sort_keys=True)
+        except (TypeError, ValueError):
+            # can't be cached, but building the plan raises a useful error
+            return cls.build_field_plan(request_fields)
+
+        return cached_field_plan(cls, request_json)
+
+    @classmethod
+    def build_field_plan(cls, request_fields):
+        """
+        Validates requested fields, recursing into linked models, and
+        resolves each field to how it is read from an instance.
+        Use :meth:`ModelExtension.compile_fields` to benefit from caching.
+        :param request_fields: Fields requested to return with the query
+        :raises: ValueError if request fields badly formatted.
+        :rtype: FieldPlan
+        """
+        fields, linked_fields = cls.sanitize_return_fields(request_fields)
+
+        direct = list()
+        columns = list()
+        for name in fields:
+            serializer = cls.field_serializers.get(name)
+            try:
+                field = cls._meta.get_field(name)
+            except FieldDoesNotExist:
+                # summary and contextual fields are read from properties
+                direct.append(DirectField(name, name, False, serializer))
+                columns = None
+            else:
+                direct.append(DirectField(
+                    name, field.attname, field.is_relation, serializer
+                ))
+                # __serial properties are read from the model too
+                serial_name = f'{name}{cls.SERIAL_EXTENSION}'
+                if hasattr(cls, serial_name) or not field.concrete:
+                    columns = None
+                elif columns is not None:
+                    columns.append(field.attname)
+
+        linked = list()
+        for name, options in linked_fields.items():
+            model_field = cls._meta.get_field(name)
+            model = model_field.related_model
+
+            if model_field.many_to_many or model_field.one_to_many:
+                sub_fields, order = model.sanitize_multi_link_options(options)
+                # validate order before any values are queried
+                model.order_by(order, model.objects.none())
+                linked.append(LinkedField(
+                    name, True, order, model.compile_fields(sub_fields)
+                ))
+            else:
+                # single model links can't be sorted or filtered, so we can
+                # assume the options are just the requested fields
+                linked.append(LinkedField(
+                    name, False, None, model.compile_fields(options)
+                ))
+
+        if linked or not columns:
+            columns = None
+        else:
+            columns = tuple(columns)
+
+        return FieldPlan(cls, tuple(direct), tuple(linked), columns)
+
+    @classmethod
+    def related_lookups(cls, request_fields, context=None, prefix=''):
+        """
+        Compiles requested fields into the relations that need to be loaded
+        up front for :meth:`ModelExtension.serialize_values` to run without
+        querying the database per instance.
+        Single links (and relations read by summary fields) are joined with
+        select_related, multi-links are loaded with one prefetch query per
+        relation, ordered by the nested 'order' option if provided.
+        Contextual membership fields are loaded with one prefetch query per
+        field, limited to links with the context.
+        :param request_fields: Fields requested to return with the query, as
+                               accepted by
+                               :meth:`ModelExtension.compile_fields`
+        :param context: User the contextual fields will be serialized for
+        :param prefix: Lookup path from the root queryset to current model
+        :raises: ValueError if request fields badly formatted.
+        :return: list of select_related lookups, list of prefetch lookups
+        :rtype: tuple[list[str], list[Prefetch]]
+        """
+        select_related = list()
+        prefetch_related = list()
+
+        plan = cls.compile_fields(request_fields)
+        fields = [field.name for field in plan.fields]
+
+        for field in fields:
+            for path in cls.field_dependencies(field):
+                relations = path.split('__')[:-1]
+                for i in range(len(relations)):
+                    lookup = prefix + '__'.join(relations[:i + 1])
+                    if lookup not in select_related:
+                        select_related.append(lookup)
+
+        # contextual fields can only be links to a logged in user
+        if context is not None and context.is_authenticated:
+            for field in fields:
+                options = cls.contextual.options.get(field) or {}
+                relation = options.get('membership')
+                if relation:
+                    model = cls._meta.get_field(relation).related_model
+                    values = model.objects.filter(pk=context.pk).only('pk')
+                    prefetch_related.append(Prefetch(
+                        f'{prefix}{relation}', queryset=values,
+                        to_attr=context_name(field)
+                    ))
+
+        for link in plan.linked:
+            model = link.plan.model
+            lookup = f'{prefix}{link.name}'
+
+            # models prefetched across a reverse foreign key are matched to
+            # the current model by that key, so it must be loaded too
+            model_field = cls._meta.get_field(link.name)
+            columns = ()
+            if model_field.one_to_many or (
+                    model_field.one_to_one and not model_field.concrete):
+                columns = (model_field.field.name, )
+
+            if link.is_multi:
+                values = model.order_by(link.order, model.objects.all())
+                values = model.plan_queryset(
+                    values, link.plan, context, columns=columns
+                )
+                prefetch_related.append(Prefetch(lookup, queryset=values))
+            elif model.field_annotations(link.plan):
+                # annotations can't be joined onto the current query, so
+                # load the linked models with their own annotated query.
+                # Joining them for summary fields as well would skip the
+                # prefetch, so load the columns those read in it instead
+                columns += tuple(
+                    path[len(link.name) + 2:]
+                    for field in fields
+                    for path in cls.field_dependencies(field)
+                    if path.startswith(f'{link.name}__')
+                )
+                values = model.plan_queryset(
+                    model.objects.all(), link.plan, context, columns=columns
+                )
+                prefetch_related.append(Prefetch(lookup, queryset=values))
+                select_related = [
+                    s for s in select_related
+                    if s != lookup and not s.startswith(f'{lookup}__')
+                ]
+            else:
+                if lookup not in select_related:
+                    select_related.append(lookup)
+                sub_select, sub_prefetch = model.related_lookups(
+                    link.plan, context, prefix=f'{lookup}__'
+                )
+                select_related.extend(
+                    s for s in sub_select if s not in select_related
+                )
+                prefetch_related.extend(sub_prefetch)
+
+        return select_related, prefetch_related
+
+    @classmethod
+    def plan_queryset(cls, values, request_fields, context=None, columns=()):
+        """
+        Applies the related lookups needed to serialize requested fields to
+        a queryset, so a page of results costs a constant number of queries,
+        and limits the loaded columns to those serializing them reads.
+        Contextual fields are planned for the given context only, so the
+        results should be serialized with the same context.
+        :param values: Queryset of current model
+        :param request_fields: Fields requested to return with the query
+        :param context: User the contextual fields will be serialized for
+        :param columns: Additional field paths to load
+        :raises: ValueError if request fields badly formatted.
+        :return: Queryset with related models loaded
+        """
+        select_related, prefetch_related = cls.related_lookups(
+            request_fields, context
+        )
+        columns = cls.field_columns(request_fields) + list(columns)
+        values = values.only(*dict.fromkeys(columns))
+
+        annotations = cls.field_annotations(request_fields)
+        if annotations:
+            values = values.annotate(**annotations)
+        if select_related:
+            values = values.select_related(*select_related)
+        if prefetch_related:
+            values = values.prefetch_related(*prefetch_related)
+
+        return values
+
+    @classmethod
+    def field_columns(cls, request_fields, prefix=''):
+        """
+        Field paths to load with only(), so that rows transferred from the
+        database match what serializing requested fields reads. Includes the
+        columns of single links joined by the query planner, and the field
+        paths summary and contextual fields declare they depend on.
+        :param request_fields: Fields requested to return with the query
+        :param prefix: Lookup path from the root queryset to current model
+        :raises: ValueError if request fields badly formatted.
+        :rtype: list[str]
+        """
+        plan = cls.compile_fields(request_fields)
+        paths = [cls._meta.pk.name]
+
+        for field in plan.fields:
+            try:
+                model_field = cls._meta.get_field(field.name)
+            except FieldDoesNotExist:
+                # load each relation on the path, as well as the field
+                for path in cls.field_dependencies(field.name):
+                    path = path.split('__')
+                    paths.extend(
+                        '__'.join(path[:i + 1]) for i in range(len(path))
+                    )
+            else:
+                if model_field.concrete:
+                    paths.append(field.name)
+
+        columns = [f'{prefix}{path}' for path in paths]
+
+        for link in plan.linked:
+            model = link.plan.model
+            if link.is_multi or model.field_annotations(link.plan):
+                # prefetched separately, with any columns summary fields
+                # read through the link
+                nested = f'{prefix}{link.name}__'
+                columns = [c for c in columns if not c.startswith(nested)]
+                continue
+
+            if cls._meta.get_field(link.name).concrete:
+                columns.append(f'{prefix}{link.name}')
+            columns.extend(model.field_columns(
+                link.plan, prefix=f'{prefix}{link.name}__'
+            ))
+
+        return list(dict.fromkeys(columns))
+
+    @classmethod
+    def plan_rows(cls, values, request_fields, order=None):
+        """
+        Switches a queryset to values() rows of only the columns needed to
+        serialize requested fields, if none of them need a model instance,
+        to skip building models for flat requests. Rows also hold the pk and
+        order column, so they can be paginated as normal.
+        :param values: Queryset of current model
+        :param request_fields: Fields requested to return with the query
+        :param order: Field the queryset is ordered by, if any, as validated
+                      by :meth:`ModelExtension.order_by`
+        :raises: ValueError if request fields badly formatted.
+        :return: values() queryset, to serialize with
+                 :meth:`ModelExtension.serialize_rows`, or None if the
+                 requested fields need model instances
+        """
+        columns = cls.compile_fields(request_fields).columns
+        if columns is None:
+            return
+
+        columns = list(columns)
+        if order:
+            field_name = order.lstrip('-')
+            if field_name == 'pk':
+                field = cls._meta.pk
+            else:
+                field = cls._meta.get_field(field_name)
+            columns.append(field.attname)
+
+        return values.values('pk', *dict.fromkeys(columns))
+
+    @classmethod
+    def serialize_rows(cls, rows, request_fields):
+        """
+        Serializes rows from a queryset planned by
+        :meth:`ModelExtension.plan_rows`.
+        :param rows: Iterable of row dicts
+        :param request_fields: Fields requested to return with the query
+        :raises: ValueError if request fields badly formatted.
+        :return: list of json serializable dictionaries of field-value pairs
+        """
+        plan = cls.compile_fields(request_fields)
+        profile = active_profile.get()
+
+        serial_rows = list()
+        for row in rows:
+            serial_dict = dict()
+            for field in plan.fields:
+                if profile is not None:
+                    start = time.perf_counter()
+
+                value = row[field.attname]
+                if field.is_link:
+                    value = {'id': value}
+                elif field.serializer is not None and value is not None:
+                    # only converters registered by field type are planned,
+                    # which don't need the model instance
+                    value = field.serializer(None, value)
+                serial_dict[field.name] = value
+
+                if profile is not None:
+                    profile.add(cls, field.name, time.perf_counter() - start)
+            serial_rows.append(serial_dict)
+
+        return serial_rows
+
+    @classmethod
+    def export(cls, request_fields, chunk_size=2000):
+        """
+        Serializes every model of the current class, ordered by pk, reading
+        them from the database in chunks so memory use stays constant
+        regardless of table size.
+        :param request_fields: Fields to serialize, as accepted by
+                               :meth:`ModelExtension.compile_fields`
+        :param chunk_size: Number of models read from the database at once
+        :raises: ValueError if request fields badly formatted.
+        :return: generator of json serializable dictionaries
+        """
+        plan = cls.compile_fields(request_fields)
+        values = cls.objects.order_by('pk')
+
+        rows = cls.plan_rows(values, plan, 'pk')
+        if rows is not None:
+            rows = rows.iterator(chunk_size=chunk_size)
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    return
+                yield from cls.serialize_rows(chunk, plan)
+
+        values = cls.plan_queryset(values, plan)
+        for model in values.iterator(chunk_size=chunk_size):
+            yield model.serialize(plan)
+
+    @classmethod
+    def export_links(cls, field, chunk_size=2000):
+        """
+        Every link on a many-to-many field, read from the through table in
+        chunks.
+        :param field: Name of many-to-many field on current model
+        :param chunk_size: Number of links read from the database at once
+        :return: generator of (current model pk, linked model pk)
+        """
+        through, source, target = cls.through_table(field)
+        links = through.objects.order_by('pk').values_list(source, target)
+        yield from links.iterator(chunk_size=chunk_size)
+
+    @classmethod
+    def field_annotations(cls, request_fields):
+        """
+        Aggregate expressions for requested summary fields that declare one,
+        keyed by annotation name.
+        :param request_fields: Fields requested to return with the query
+        :raises: ValueError if request fields badly formatted.
+        :rtype: dict
+        """
+        annotations = dict()
+
+        for field in cls.compile_fields(request_fields).fields:
+            field = field.name
+            options = cls.summary.options.get(field) or {}
+            if 'counter' in options and use_counters():
+                continue
+            if 'aggregate' in options:
+                # evaluate each aggregate in a correlated subquery, so it is
+                # not skewed by joins on the outer query (e.g. the filter a
+                # prefetch adds on the same relation) or other aggregates
+                name = annotation_name(field)
+                aggregate = cls.objects.filter(
+                    pk=OuterRef('pk')
+                ).annotate(**{name: options['aggregate']}).values(name)
+                annotations[name] = Subquery(aggregate)
+
+        return annotations
+
+    @classmethod
+    def field_dependencies(cls, field):
+        """
+        Field paths read by a summary or contextual field, as declared by the
+        'depends' option of their label.
+        :param field: Name of field on current model
+        :rtype: tuple[str]
+        """
+        for label in (cls.summary, cls.contextual):
+            options = label.options.get(field)
+            if options:
+                depends = options.get('depends', ())
+                if 'counter' in options and use_counters():
+                    depends += (options['counter'][1], )
+                return depends
+        return ()
+
+    @classmethod
+    def counters(cls):
+        """
+        Counter columns declared by summary fields, keyed by the multi-link
+        field they count.
+        :rtype: dict
+        """
+        counters = dict()
+        for options in cls.summary.options.values():
+            if 'counter' in options:
+                relation, column = options['counter']
+                counters[relation] = column
+
+        return counters
+
+    def is_prefetched(self, field):
+        """
+        Checks if a multi-link field was loaded by prefetch_related, in which
+        case its values are already cached on the instance.
+        :param field: Name of multi-link field on current model
+        :rtype: bool
+        """
+        return field in getattr(self, '_prefetched_objects_cache', {})
+
     @classmethod
     def parse_filters(cls, filters):
         """
@@ -183,6 +1376,9 @@ class ModelExtension(object):
             [{<field>: (<operator>, <value>)}]
             e.g. [{'id': {'is', 1}}]
         Fields will be sanitised, and must be valid for the model provided.
+        Fields on related models can be filtered by joining linked field names
+        with '__', e.g. posts by users followed by user 1:
+            [{'user__followers': {'is': 1}}]
         Currently supported operators are:
             == -> positively filter field by value
             != -> negatively filter field by value
@@ -214,13 +1410,10 @@ class ModelExtension(object):
         exclude_dict = dict()
 
         # TODO: support for filtering on non-db fields
-        fields = cls.default_fields()
-
         for f in filters:
             for field, operators in f.items():
                 for operator, value in operators.items():
-                    if field not in fields:
-                        raise ValueError(f'invalid field - {field}')
+                    db_field = cls.filter_field(field)
                     if operator not in OPERATORS.keys():
                         raise ValueError(f'invalid operator - {operator}')
 
@@ -228,7 +1421,6 @@ class ModelExtension(object):
                     lookup_key = f'{field}__{lookup}'
 
                     # TODO: data type manager
-                    db_field = getattr(cls, field).field
                     if lookup == 'in':
                         if not isinstance(value, list):
                             raise ValueError(
@@ -251,6 +1443,64 @@ class ModelExtension(object):
 
         return filter_dict, exclude_dict
 
+    @classmethod
+    def filter_field(cls, path):
+        """
+        Resolves a filter field to the model field it compares against.
+        Filter fields are direct fields on the current model, or a path of
+        linked fields joined by '__' ending in a direct or linked field, so
+        the join is resolved in the database.
+        :param path: Name of field, or '__' separated path of fields
+        :raises: ValueError if the field can't be filtered on
+        :return: Django model field (or relation) at the end of the path
+        """
+        model = cls
+        names = path.split('__')
+        for i, name in enumerate(names):
+            is_last = i == len(names) - 1
+            if not issubclass(model, ModelExtension):
+                raise ValueError(f'invalid field - {path}')
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                raise ValueError(f'invalid field - {path}')
+
+            if field.is_relation:
+                model = field.related_model
+            elif not is_last or name not in model.default_fields():
+                raise ValueError(f'invalid field - {path}')
+
+        # multi-links can only be compared directly through a path
+        if len(names) == 1 and name not in cls.default_fields():
+            raise ValueError(f'invalid field - {path}')
+
+        return field
+
+    @classmethod
+    def filters_fan_out(cls, includes):
+        """
+        Whether filtering by includes can match a model more than once, by
+        joining through multi-links, so the results need to be distinct.
+        Comparing the last multi-link on a path by exact id can only match
+        one of its links, e.g. posts by users followed by user 1.
+        :param includes: Filters from :meth:`ModelExtension.parse_filters`
+        :rtype: bool
+        """
+        for key in includes:
+            *names, lookup = key.split('__')
+            model = cls
+            multi = list()
+            for name in names:
+                field = model._meta.get_field(name)
+                multi.append(bool(field.one_to_many or field.many_to_many))
+                model = field.related_model
+
+            links = sum(multi)
+            if links > 1 or (links and (lookup != 'exact' or not multi[-1])):
+                return True
+
+        return False
+
     @classmethod
     def order_by(cls, field, values):
 
@@ -272,9 +1522,95 @@ class ModelExtension(object):
 
         return values
 
+    @classmethod
+    def paginate_cursor(cls, values, order, cursor, limit):
+        """
+        Paginates values by seeking past a cursor on (order field, pk), so no
+        count is required and each page is an index range scan.
+        :param values: Queryset of current model, already validated by
+                       :meth:`ModelExtension.order_by`, optionally of rows
+                       from :meth:`ModelExtension.plan_rows`
+        :param order: Field to order by, optionally prefixed by '-' for
+                      descending order. Defaults to primary key.
+        :param cursor: Cursor returned with a previous page, or None for the
+                       first page
+        :param limit: Maximum number of results per page
+        :raises: ValueError if cursor is invalid or the order field nullable
+        :return: list of models (or rows), next cursor and previous cursor
+                 (cursors are None if there are no results in that
+                 direction)
+        """
+        order = order or 'pk'
+        descending = order.startswith('-')
+        field_name = order.lstrip('-')
+        if field_name == 'pk':
+            field = cls._meta.pk
+        else:
+            field = cls._meta.get_field(field_name)
+        if field.null:
+            raise ValueError(f'cannot paginate by nullable field {field_name}')
+
+        keys = [field_name]
+        if not field.primary_key:
+            keys.append('pk')
+
+        backwards = False
+        if cursor is not None:
+            cursor_order, value, pk, backwards = decode_cursor(cursor)
+            if cursor_order != order:
+                raise ValueError(
+                    f'cursor was ordered by {cursor_order} - got {order}'
+                )
+            try:
+                value = field.to_python(value)
+                pk = cls._meta.pk.to_python(pk)
+                assert isinstance(backwards, bool)
+            except (ValidationError, TypeError, ValueError, AssertionError):
+                raise ValueError(f'invalid cursor position {value}, {pk}')
+
+        # walk the index in reverse order when paging backwards
+        reverse = descending != backwards
+        values = values.order_by(*[f'-{k}' if reverse else k for k in keys])
+
+        if cursor is not None:
+            lookup = 'lt' if reverse else 'gt'
+            position = Q(**{f'{field_name}__{lookup}': value})
+            if not field.primary_key:
+                position |= Q(**{field_name: value, f'pk__{lookup}': pk})
+            values = values.filter(position)
+
+        # fetch one extra to check for results beyond this page
+        values = list(values[:limit + 1])
+        has_more = len(values) > limit
+        values = values[:limit]
+        if backwards:
+            values.reverse()
+
+        has_next = has_more if not backwards else cursor is not None
+        has_previous = cursor is not None if not backwards else has_more
+
+        def position(result):
+            # rows from a values() query hold the pk and order column
+            if isinstance(result, dict):
+                result = cls(
+                    pk=result['pk'], **{field.attname: result[field.attname]}
+                )
+            return field.value_to_string(result), result.pk
+
+        next_cursor = prev_cursor = None
+        if values and has_next:
+            next_cursor = encode_cursor(order, *position(values[-1]))
+        if values and has_previous:
+            prev_cursor = encode_cursor(
+                order, *position(values[0]), backwards=True
+            )
+
+        return values, next_cursor, prev_cursor
+
     @classmethod
     def serializable_fields(cls):
-        fields = cls.default_fields()
+        # counter columns are served through their summary fields
+        fields = cls.default_fields().difference(cls.counters().values())
         fields = fields.union(cls.summary_fields())
         fields = fields.union(cls.contextual_fields())
 
@@ -286,7 +1622,8 @@ class ModelExtension(object):
         If fields are not valid, they will be returned as None.
         :param fields: List of direct (as str) and linked (as dict) fields
                        Also accepts :attr:`ModelExtension.SELECT_ALL` as
-                       short-hand for all direct fields on current model.
+                       short-hand for all direct fields on current model, or
+                       a :class:`FieldPlan` compiled from either.
         :type fields: list[str, dict] or :attr:`ModelExtension.SELECT_ALL`
         :raises: ValueError if sanitization fails
         :return: Json serializable dictionary of field-value pairs
@@ -294,51 +1631,54 @@ class ModelExtension(object):
         # add valid fields to dict
         serial_dict = dict()
 
-        fields, linked_fields = self.sanitize_return_fields(fields)
+        plan = self.compile_fields(fields)
+        profile = active_profile.get()
 
-        for field in fields:
-            value = self.serializable_value(field)
-            serial_dict[field] = value
-
-        for field, options in linked_fields.items():
-            value = getattr(self, field)
-            is_multi_link = hasattr(value, 'all')
-            if is_multi_link:
-
-                model = self._meta.get_field(field).related_model
-
-                # extract values from multi-link field, if any
-                if isinstance(options, dict):
-                    sub_fields = options.get('fields')
-                    order = options.get('order')
-                # assume list of fields if no options given
-                elif isinstance(options, list):
-                    sub_fields = options
-                    order = None
-                # bail out if input recognised
-                elif options == model.SELECT_ALL:
-                    sub_fields = options
-                    order = None
-                else:
-                    raise ValueError(
-                        f'multi-link field expects fields as list, '
-                        f'options as dict, or {model.SELECT_ALL} '
-                        f'- got {type(options)}'
-                    )
+        for field in plan.fields:
+            if profile is not None:
+                start = time.perf_counter()
+
+            if field.is_link:
+                # foreign keys hold the linked id, so no need to load it
+                value = {'id': getattr(self, field.attname)}
+            else:
+                value = getattr(self, field.attname)
+                if field.serializer is not None and value is not None:
+                    value = field.serializer(self, value)
+
+            serial_dict[field.name] = value
+            if profile is not None:
+                profile.add(
+                    type(self), field.name, time.perf_counter() - start
+                )
+
+        for link in plan.linked:
+            if profile is not None:
+                start = time.perf_counter()
+
+            value = getattr(self, link.name)
+            if link.is_multi:
 
                 # collect and serialize related models, optionally ordering
+                # prefetched values were already ordered by the query planner
                 values = value.all()
-                if order:
-                    values = model.order_by(order, values)
-                values = [m.serialize_values(sub_fields) for m in values]
-
+                if link.order and not self.is_prefetched(link.name):
+                    values = link.plan.model.order_by(link.order, values)
+                values = [
+                    m.serialize(link.plan, self._context) for m in values
+                ]
+
+            elif value is None:
+                values = None
             else:
                 # we can assume this is a 1-1 or 1-many relation
-                # single model links can't be sorted or filtered, so we can
-                # also assume the options are just the requested fields
-                values = value.serialize_values(options)
+                values = value.serialize(link.plan, self._context)
 
-            serial_dict[field] = values
+            serial_dict[link.name] = values
+            if profile is not None:
+                profile.add(
+                    type(self), link.name, time.perf_counter() - start
+                )
 
         return serial_dict
 
@@ -358,43 +1698,430 @@ class ModelExtension(object):
 
     def update(self, item, context=None, multi_option=None):
         """
-        TODO
-        :param item:
-        :param context:
-        :param multi_option:
-        :return:
+        Applies an update request to the current model, see
+        :meth:`ModelExtension.update_batch`.
+        :param item: Update request, the model name and id, plus values of
+                     each field to update
+        :param context: User the updated fields are serialized for
+        :param multi_option: Mode (add, remove or set) of each multi-link
+                             field, defaults to set
+        :raises: ValueError if a multi-option is invalid
+        :return: Json serializable dictionary of updated fields
         """
+        return self.update_batch([(self, item)], context, multi_option)[0]
 
+    @classmethod
+    def update_batch(cls, updates, context=None, multi_option=None):
+        """
+        Applies update requests to models of the current class in bulk,
+        in a single transaction. Direct fields are written with one
+        bulk_update per set of updated fields, and multi-links with one
+        insert and one delete on the through table of each field.
+        :param updates: list of (model instance, update request) pairs
+        :param context: User the updated fields are serialized for
+        :param multi_option: Mode (add, remove or set) of each multi-link
+                             field, defaults to set
+        :raises: ValueError if a multi-option is invalid
+        :return: list of json serializable dictionaries of updated fields,
+                 in the same order as updates
+        """
         multi_option = multi_option or {}
+        counters = cls.counters().values()
 
+        changed = defaultdict(list)
+        links = defaultdict(list)
         return_fields = list()
-        for key, value in item.items():
-            if key in ('model', 'id'):
-                continue
-            field = getattr(self, key)
-            mode = multi_option.get(key) or 'set'
-            if isinstance(field, Manager):
-                if mode == 'add':
-                    field.add(value)
-                elif mode == 'remove':
-                    field.remove(value)
-                elif mode == 'set':
-                    field.set([value])
+        for instance, item in updates:
+            fields = list()
+            item_fields = list()
+            for key, value in item.items():
+                if key in ('model', 'id'):
+                    continue
+                field = getattr(instance, key)
+                mode = multi_option.get(key) or 'set'
+                if isinstance(field, Manager):
+                    if mode not in ('add', 'remove', 'set'):
+                        raise ValueError(
+                            f'multi-option can be add, remove or set '
+                            f'- got {multi_option}'
+                        )
+                    links[key].append((instance, value, mode))
+                    item_fields.append({key: ['id']})
                 else:
-                    raise ValueError(
-                        f'multi-option can be add, remove or set '
-                        f'- got {multi_option}'
-                    )
-                return_fields.append({key: ['id']})
+                    setattr(instance, key, value)
+                    # counter columns are only written with F() increments
+                    if key in cls.default_fields() and key not in counters:
+                        fields.append(key)
+                    item_fields.append(key)
+            if fields:
+                changed[tuple(sorted(set(fields)))].append(instance)
+            return_fields.append(item_fields)
+
+        # only the touched columns are written, and models with only link
+        # changes aren't written at all
+        with transaction.atomic():
+            for fields, instances in changed.items():
+                if len(instances) == 1:
+                    instances[0].save(update_fields=fields)
+                else:
+                    cls.objects.bulk_update(instances, fields)
+                    # bulk writes don't send the signals that bump
+                    # generations
+                    bump_generation(cls)
+            for field, changes in links.items():
+                cls.update_links(field, changes)
+
+        # serialize updated models, with a planned query for each distinct
+        # set of returned fields
+        pks = defaultdict(list)
+        for (instance, _), item_fields in zip(updates, return_fields):
+            pks[json.dumps(item_fields)].append(instance.pk)
+        updated = dict()
+        for fields, group in pks.items():
+            values = cls.plan_queryset(
+                cls.objects.filter(pk__in=group), json.loads(fields), context
+            )
+            updated[fields] = values.in_bulk()
+
+        result = list()
+        for (instance, item), item_fields in zip(updates, return_fields):
+            model = updated[json.dumps(item_fields)][instance.pk]
+            serial_value = model.serialize(item_fields, context)
+            serial_value['id'] = item['id']
+            serial_value['model'] = item['model']
+            result.append(serial_value)
+
+        return result
+
+    @classmethod
+    @transaction.atomic
+    def update_links(cls, field, changes):
+        """
+        Adds, removes or sets links on a multi-link field of many models,
+        only writing the links that actually change, then notifies
+        :meth:`ModelExtension.relations_changed` of all changed models.
+        Many-to-many links are written with a single insert and delete on
+        the through table, after locking the models at both ends, so that
+        concurrent updates of the same links can't count them twice.
+        :param field: Name of multi-link field on current model
+        :param changes: list of (model instance, id or list of ids, mode)
+        :raises: ValueError if an id isn't valid for the linked model
+        """
+        model_field = cls._meta.get_field(field)
+        if not model_field.many_to_many:
+            # reverse foreign keys are written through the linked models
+            for instance, value, mode in changes:
+                instance.update_relation(field, value, mode)
+            return
+
+        through, source, target = cls.through_table(field)
+        related_model = model_field.related_model
+        to_python = related_model._meta.pk.to_python
+
+        requested = list()
+        locks = defaultdict(set)
+        existing_filter = Q()
+        for instance, value, mode in changes:
+            # ids are compared with the stored links, so must be the same type
+            try:
+                ids = {
+                    to_python(pk)
+                    for pk in (value if isinstance(value, list) else [value])
+                }
+            except ValidationError:
+                raise ValueError(f'invalid ids for {field} - got {value}')
+            requested.append((instance, ids, mode))
+            locks[cls].add(instance.pk)
+            locks[related_model].update(ids)
+            if mode == 'set':
+                existing_filter |= Q(**{source: instance.pk})
+            else:
+                existing_filter |= Q(
+                    **{source: instance.pk, f'{target}__in': ids}
+                )
+
+        # links are read before they are written, so a concurrent update
+        # must wait for this one to commit, or both would count the same
+        # links as changed. Rows are locked in order to avoid deadlocks
+        for model, pks in locks.items():
+            list(model.objects.select_for_update().filter(
+                pk__in=pks
+            ).order_by('pk').values_list('pk', flat=True))
+
+        existing = defaultdict(set)
+        for source_pk, target_pk in through.objects.filter(
+                existing_filter).values_list(source, target):
+            existing[source_pk].add(target_pk)
+
+        inserts = list()
+        deletes = Q()
+        changed = list()
+        for instance, ids, mode in requested:
+            links = existing[instance.pk]
+            if mode == 'set':
+                added, removed = ids - links, links - ids
+            elif mode == 'add':
+                added, removed = ids - links, set()
             else:
-                setattr(self, key, value)
-                return_fields.append(key)
-        self.save()
-        serial_value = self.serialize(return_fields, context)
-        serial_value['id'] = item['id']
-        serial_value['model'] = item['model']
+                added, removed = set(), links & ids
+
+            inserts.extend(
+                through(**{source: instance.pk, target: pk}) for pk in added
+            )
+            if removed:
+                deletes |= Q(**{source: instance.pk, f'{target}__in': removed})
+            if added or removed:
+                changed.append((instance, added, removed))
+
+        # links inserted since they were read are left as they are
+        if inserts:
+            through.objects.bulk_create(inserts, ignore_conflicts=True)
+        if deletes:
+            through.objects.filter(deletes).delete()
+
+        if changed:
+            cls.relations_changed(field, [
+                (instance.pk, added, removed)
+                for instance, added, removed in changed
+            ])
+            # through table writes don't send m2m_changed, so bump the
+            # generations of both sides here
+            bump_generation(cls, related_model)
+
+    def update_relation(self, field, value, mode):
+        """
+        Adds, removes or sets links on a multi-link field, only writing the
+        links that actually change, then notifies
+        :meth:`ModelExtension.relation_changed`.
+        :param field: Name of multi-link field on current model
+        :param value: Id, or list of ids, of models to link
+        :param mode: One of add, remove or set
+        :return: set of added ids, set of removed ids
+        """
+        manager = getattr(self, field)
+        ids = set(value if isinstance(value, list) else [value])
+
+        if mode == 'set':
+            existing = set(manager.values_list('pk', flat=True))
+            added, removed = ids - existing, existing - ids
+        else:
+            existing = set(
+                manager.filter(pk__in=ids).values_list('pk', flat=True)
+            )
+            if mode == 'add':
+                added, removed = ids - existing, set()
+            else:
+                added, removed = set(), existing
+
+        if added:
+            manager.add(*added)
+        if removed:
+            manager.remove(*removed)
+        if added or removed:
+            self.relation_changed(field, added, removed)
+
+        return added, removed
+
+    @classmethod
+    def through_table(cls, field):
+        """
+        Through model of a many-to-many field on the current model, whose
+        rows link from the current model (source) to the linked model
+        (target).
+        :param field: Name of many-to-many field on current model
+        :return: through model, source column, target column
+        :rtype: tuple[Model, str, str]
+        """
+        model_field = cls._meta.get_field(field)
+        if isinstance(model_field, ForeignObjectRel):
+            m2m = model_field.field
+            source, target = m2m.m2m_reverse_name(), m2m.m2m_column_name()
+        else:
+            m2m = model_field
+            source, target = m2m.m2m_column_name(), m2m.m2m_reverse_name()
+
+        return m2m.remote_field.through, source, target
+
+    @classmethod
+    def toggle_link(cls, pk, field, value, linked=True):
+        """
+        Links or unlinks a single model on a many-to-many field, writing only
+        the through table, without reading or saving the current model.
+        Repeated requests are no-ops, including concurrent ones, as only the
+        request whose insert or delete touched a row counts as a change.
+        Counter columns and :meth:`ModelExtension.relation_changed` are only
+        updated if the link changed.
+        :param pk: Primary key of model on current class
+        :param field: Name of many-to-many field on current model
+        :param value: Primary key of model to link or unlink
+        :param linked: True to link the model, False to unlink it
+        :return: True if the link changed
+        :rtype: bool
+        """
+        through, source, target = cls.through_table(field)
+        link = {source: pk, target: value}
+
+        if linked:
+            # the unique constraint rejects the duplicate, in a savepoint so
+            # the surrounding transaction can carry on
+            try:
+                with transaction.atomic():
+                    through.objects.create(**link)
+            except IntegrityError:
+                return False
+            added, removed = {value}, set()
+        else:
+            deleted, _ = through.objects.filter(**link).delete()
+            if not deleted:
+                return False
+            added, removed = set(), {value}
 
-        return serial_value
+        cls(pk=pk).relation_changed(field, added, removed)
+        bump_generation(cls, cls._meta.get_field(field).related_model)
+
+        return True
+
+    @classmethod
+    def link_state(cls, pk, field, value):
+        """
+        Reads the links of a model on a many-to-many field in one query:
+        their count, from its counter column if :func:`use_counters`,
+        otherwise from the through table, and whether a model is linked.
+        :param pk: Primary key of model on current class
+        :param field: Name of many-to-many field on current model
+        :param value: Primary key of the linked model to look for
+        :return: count of links and True if value is linked, or None if no
+                 model has the primary key
+        :rtype: tuple
+        """
+        through, source, target = cls.through_table(field)
+        links = through.objects.filter(**{source: OuterRef('pk')})
+        column = cls.counters().get(field)
+        if column and use_counters():
+            count = F(column)
+        else:
+            count = Coalesce(Subquery(
+                links.order_by().values(source).annotate(
+                    count=Count('pk')
+                ).values('count')
+            ), 0)
+
+        return cls.objects.filter(pk=pk).values_list(
+            count, Exists(links.filter(**{target: value}))
+        ).first()
+
+    def relation_changed(self, field, added, removed):
+        """
+        Hook called after links on a multi-link field of the current model
+        changed, see :meth:`ModelExtension.relations_changed`.
+        :param field: Name of multi-link field on current model
+        :param added: ids of newly linked models
+        :param removed: ids of unlinked models
+        """
+        type(self).relations_changed(field, [(self.pk, added, removed)])
+
+    @classmethod
+    def relations_changed(cls, field, changes):
+        """
+        Hook called after links on a multi-link field changed, on one or
+        more models. Keeps counter columns on both sides of the relation in
+        sync with F() increments, with one update per distinct increment
+        rather than per model.
+        :param field: Name of multi-link field on current model
+        :param changes: list of (model id, added ids, removed ids)
+        """
+        column = cls.counters().get(field)
+        if column:
+            deltas = defaultdict(list)
+            for pk, added, removed in changes:
+                delta = len(added) - len(removed)
+                if delta:
+                    deltas[delta].append(pk)
+            for delta, pks in deltas.items():
+                cls.objects.filter(pk__in=pks).update(
+                    **{column: F(column) + delta}
+                )
+
+        # each linked model gained or lost one link on the far side per
+        # model it was linked to or unlinked from
+        model_field = cls._meta.get_field(field)
+        if isinstance(model_field, ForeignObjectRel):
+            remote_name = model_field.field.name
+        else:
+            remote_name = model_field.remote_field.get_accessor_name()
+        model = model_field.related_model
+        column = getattr(model, 'counters', dict)().get(remote_name)
+        if column:
+            steps = defaultdict(int)
+            for _, added, removed in changes:
+                for pk in added:
+                    steps[pk] += 1
+                for pk in removed:
+                    steps[pk] -= 1
+            ids = defaultdict(list)
+            for pk, step in steps.items():
+                if step:
+                    ids[step].append(pk)
+            for step, pks in ids.items():
+                model.objects.filter(pk__in=pks).update(
+                    **{column: F(column) + step}
+                )
+
+    @classmethod
+    def reconcile_counters(cls, dry_run=False):
+        """
+        Recounts every counter column on the current model, correcting any
+        drift from writes that bypassed :meth:`ModelExtension.update`.
+        :param dry_run: Only report drift, without correcting it
+        :return: Number of drifted rows per counter column
+        :rtype: dict
+        """
+        drift = dict()
+        for relation, column in cls.counters().items():
+            actual = Subquery(cls.objects.filter(
+                pk=OuterRef('pk')
+            ).annotate(actual=Count(relation)).values('actual'))
+
+            drifted = cls.objects.annotate(actual=actual).exclude(
+                **{column: F('actual')}
+            )
+            drift[column] = drifted.count()
+            if drift[column] and not dry_run:
+                cls.objects.update(**{column: actual})
+                bump_generation(cls)
+
+        return drift
+
+    def save(self, *args, **kwargs):
+        # counter columns are only written with F() increments, so make sure
+        # saving a (possibly stale) instance doesn't overwrite them
+        counters = self.counters().values()
+        partial = kwargs.get('update_fields') is not None
+        forced = kwargs.get('force_insert') or kwargs.get('force_update')
+        if (counters and not partial and not forced and
+                not self._state.adding and not args):
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in counters
+                and f.attname not in deferred
+            ]
+            # a failed partial save breaks the surrounding transaction, so
+            # it needs its own savepoint to fall back to a plain save
+            savepoint = contextlib.nullcontext()
+            if connection.in_atomic_block:
+                savepoint = transaction.atomic()
+            try:
+                with savepoint:
+                    return super().save(
+                        update_fields=update_fields, **kwargs
+                    )
+            except DatabaseError:
+                # the row was deleted, so insert it again as a plain save
+                # would, rather than failing the partial update
+                if type(self)._base_manager.filter(pk=self.pk).exists():
+                    raise
+        super().save(*args, **kwargs)
 
     def serializable_value(self, field_name):
         """
@@ -421,8 +2148,12 @@ class ModelExtension(object):
             # attempt to get field class
             field = self._meta.get_field(base_field_name)
 
+            # foreign keys hold the linked id, so no need to load the model
+            if field.many_to_one and undotted[1:] in ([], ['id']):
+                value = {'id': getattr(self, field.attname)}
+
             # if related field, recursively query down one level
-            if isinstance(field, (RelatedField, ForeignObjectRel)):
+            elif isinstance(field, (RelatedField, ForeignObjectRel)):
                 # if no linked field provided, default to 'id'
                 relation_path = undotted[1:] or ['id']
                 linked_model = getattr(self, base_field_name)
@@ -442,15 +2173,46 @@ class ModelExtension(object):
             else:
                 return
 
-        # verify value is json serializable
-        try:
-            json.dumps(value)
-            return value
-        # otherwise attempt to run custom serialization
-        except (TypeError, OverflowError):
-            try:
-                return self.serializable_value(
-                    f'{base_field_name}{self.SERIAL_EXTENSION}'
-                )
-            except AttributeError:
-                return
+        serializer = self.field_serializers.get(base_field_name)
+        if serializer is not None and value is not None:
+            value = serializer(self, value)
+
+        return value
+
+
+@receiver(class_prepared)
+def prepare_field_serializers(sender, **kwargs):
+    """
+    Resolves the converters of each serializable field on models extended by
+    :class:`ModelExtension`, so values are converted once when serialized,
+    without probing whether they are json serializable.
+    """
+    if not issubclass(sender, ModelExtension):
+        return
+
+    sender.field_serializers = dict()
+    for name in sender.serializable_fields():
+        serializer = resolve_serializer(sender, name)
+        if serializer is not None:
+            sender.field_serializers[name] = serializer
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_saved_generation(sender, **kwargs):
+    """Invalidates cached responses when a model is saved or deleted"""
+    if issubclass(sender, ModelExtension):
+        bump_generation(sender)
+
+
+@receiver(m2m_changed)
+def bump_linked_generation(sender, instance, model, action, **kwargs):
+    """
+    Invalidates cached responses when multi-links change, which also changes
+    the counter columns on both sides.
+    """
+    if action.startswith('post_'):
+        bump_generation(*{
+            m for m in (type(instance), model)
+            if issubclass(m, ModelExtension)
+        })
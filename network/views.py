@@ -1,16 +1,41 @@
+import hmac
 import json
+from collections import defaultdict
 
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.db import IntegrityError
-from django.http import JsonResponse, HttpResponseRedirect
+from django.db import IntegrityError, transaction
+from django.http import (
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render
 from django.urls import reverse
 from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator
-
-from .models import User
-from .utils import sanitize_update_request
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+
+from .exports import EXPORTS, export_lines
+from .metrics import metrics_token, registry
+from .middleware import annotate
+from .models import User, Post, like_buffer
+from .utils import (
+    ModelExtension,
+    bump_context,
+    sanitize_update_request,
+    search_cache_timeout,
+    search_digest,
+    use_like_buffer,
+    use_search_etags,
+)
 
 MAX_RECORDS = 10
 
@@ -75,9 +100,10 @@ def register(request):
 
 def whoami(request):
 
-    if request.method != 'POST':
+    if request.method not in ('GET', 'POST'):
         return JsonResponse({
-            'error': f'Search must be POST - {request.method} not supported'
+            'error': f'Whoami must be GET or POST - '
+            f'{request.method} not supported'
         }, status=400)
 
     try:
@@ -93,20 +119,33 @@ def whoami(request):
 
 def search(request):
 
-    if request.method != 'POST':
+    # GET searches encode the query as json in the q parameter, so browsers
+    # can revalidate them with the ETag instead of downloading them again
+    if request.method == 'GET':
+        query = request.GET.get('q') or '{}'
+    elif request.method == 'POST':
+        query = request.body
+    else:
         return JsonResponse({
-            'error': f'Search must be POST - {request.method} not supported'
+            'error': f'Search must be GET or POST - '
+            f'{request.method} not supported'
         }, status=400)
 
-    query = json.loads(request.body)
-    # TODO: logging!!!
-    print(f'Got query: {query}')
+    try:
+        query = json.loads(query)
+        assert isinstance(query, dict)
+    except (ValueError, AssertionError):
+        return JsonResponse({
+            'error': f'Search query must be a json object'
+        }, status=400)
 
     model_name = query.get('model')
+    annotate(request, model=model_name)
     try:
         model = apps.get_model('network', model_name)
-    except (LookupError, ValueError, AttributeError):
-        print('model error')
+        assert issubclass(model, ModelExtension)
+    except (LookupError, ValueError, AttributeError, AssertionError):
+        annotate(request, error='model')
         return JsonResponse({
             'error': f'Model of name {model_name} does not exist'
         }, status=400)
@@ -116,70 +155,201 @@ def search(request):
     try:
         filters, excludes = model.parse_filters(filters)
     except ValueError as v:
-        print('filters error')
+        annotate(request, error='filters')
         return JsonResponse({
             'error': f'Could not parse filters: {v}'
         }, status=400)
 
-    # get values based on filters
+    # the digest changes whenever any model is written to, so it identifies
+    # the response for conditional requests and the response cache
+    digest = search_digest(query, model, request.user)
+    etag = None
+    if digest and request.method == 'GET' and use_search_etags():
+        etag = f'"{digest}"'
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            annotate(request, cache='not_modified')
+            return add_etag(not_modified, etag)
+
+    timeout = search_cache_timeout()
+    cache_key = f'network:search:{digest}' if timeout and digest else None
+    if cache_key is not None:
+        content = cache.get(cache_key)
+        annotate(request, cache='miss' if content is None else 'hit')
+        if content is not None:
+            response = HttpResponse(
+                content, content_type='application/json'
+            )
+            return add_etag(response, etag)
+
+    # get values based on filters, each only once if they join through
+    # multi-links that can match several times
     values = model.objects.filter(**filters).exclude(**excludes)
+    if model.filters_fan_out(filters):
+        values = values.distinct()
+
+    response = search_results(request, query, model, values)
+    if response.status_code != 200:
+        return response
+    if cache_key is not None:
+        cache.set(cache_key, response.content, timeout)
+
+    return add_etag(response, etag)
+
+
+def add_etag(response, etag):
+    """
+    Adds an ETag to a search response, so browsers revalidate it rather
+    than downloading it again.
+    :param response: Search response
+    :param etag: Quoted ETag of the response, or None to leave it as is
+    :return: the response
+    """
+    if etag:
+        response['ETag'] = etag
+        # results depend on the logged in user and change with any write
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Cookie', ))
+
+    return response
+
+
+@login_required
+def feed(request):
+
+    if request.method != 'POST':
+        return JsonResponse({
+            'error': f'Feed must be POST - {request.method} not supported'
+        }, status=400)
+
+    try:
+        query = json.loads(request.body)
+        assert isinstance(query, dict)
+    except (ValueError, AssertionError):
+        return JsonResponse({
+            'error': f'Feed query must be a json object'
+        }, status=400)
+
+    # the feed is always newest first, in the order of the timeline index
+    # when there is one, so it is paged by number rather than by cursor
+    if query.get('order') not in (None, '-timestamp') or 'cursor' in query:
+        annotate(request, error='order')
+        return JsonResponse({
+            'error': 'Feed is ordered by -timestamp and paged by page number'
+        }, status=400)
+    query['order'] = None
+
+    # posts by everyone the current user follows
+    values = Post.feed(request.user)
+
+    return search_results(request, query, Post, values)
+
+
+def search_results(request, query, model, values):
+    """
+    Orders, paginates and serializes search results as requested by query
+    :param request: Search request
+    :param query: Parsed search query, supporting the 'order', 'fields',
+                  'limit', 'page' and 'cursor' keys
+    :param model: Model class to search
+    :param values: Queryset of model, already filtered
+    :return: Response with the requested page of serialized results
+    :rtype: JsonResponse
+    """
 
     # sort values by field in either asc or desc order
     order = query.get('order')
     try:
         values = model.order_by(order, values)
     except ValueError as v:
-        print('order error')
+        annotate(request, error='order')
         return JsonResponse({
             'error': f'Cannot order by {order}: {v}'
         }, status=400)
 
+    # compile requested fields once for every result, and load related
+    # models they need up front, so each page costs a fixed number of queries
+    # requests for columns only are read as rows, without building models
+    fields = query.get('fields')
+    try:
+        fields = model.compile_fields(fields)
+        rows = model.plan_rows(values, fields, order)
+        if rows is not None:
+            values = rows
+        else:
+            values = model.plan_queryset(values, fields, request.user)
+    except ValueError as v:
+        annotate(request, error='serialize')
+        return JsonResponse({
+            'error': f'Invalid requested fields: {v}'
+        }, status=400)
+
     limit = query.get('limit') or MAX_RECORDS
     try:
         limit = int(limit)
         assert 0 < limit < MAX_RECORDS + 1
     except (ValueError, TypeError, AssertionError):
-        print('limit error')
+        annotate(request, error='limit')
         return JsonResponse({
             'error': f'Limit must be positive integer '
             f'between 1 and {MAX_RECORDS}- got {type(limit)} {limit}'
         }, status=400)
 
-    # paginate values by limit
-    paginator = Paginator(values, limit)
-    page = query.get('page') or 1
-    try:
-        page = int(page)
-        assert 0 < page < paginator.num_pages + 1
-    except (ValueError, TypeError, AssertionError):
-        print('page error')
-        return JsonResponse({
-            'error': f'Page must be a positive integer '
-            f'up to {paginator.num_pages} - got {type(page)} {page}'
-        }, status=400)
-    current_page = paginator.page(page)
-    values = current_page.object_list
+    if 'cursor' in query:
+        # keyset pagination, seeks past the cursor without counting results
+        try:
+            values, next_cursor, prev_cursor = model.paginate_cursor(
+                values, order, query['cursor'], limit
+            )
+        except ValueError as v:
+            annotate(request, error='cursor')
+            return JsonResponse({
+                'error': f'Invalid cursor: {v}'
+            }, status=400)
+        pagination = {
+            'nextCursor': next_cursor,
+            'prevCursor': prev_cursor,
+            'hasPrevious': prev_cursor is not None,
+            'hasNext': next_cursor is not None,
+        }
+    else:
+        # paginate values by limit
+        paginator = Paginator(values, limit)
+        page = query.get('page') or 1
+        try:
+            page = int(page)
+            assert 0 < page < paginator.num_pages + 1
+        except (ValueError, TypeError, AssertionError):
+            annotate(request, error='page')
+            return JsonResponse({
+                'error': f'Page must be a positive integer '
+                f'up to {paginator.num_pages} - got {type(page)} {page}'
+            }, status=400)
+        current_page = paginator.page(page)
+        values = current_page.object_list
+        pagination = {
+            'pageNum': page,
+            'pageCount': paginator.num_pages,
+            'hasPrevious': current_page.has_previous(),
+            'hasNext': current_page.has_next(),
+        }
 
-    fields = query.get('fields')
     try:
-        json_values = [v.serialize(fields, request.user) for v in values]
-        # if limit is 1, return data as dict not array
+        if rows is not None:
+            json_values = model.serialize_rows(values, fields)
+        else:
+            json_values = [v.serialize(fields, request.user) for v in values]
+        annotate(request, rows=len(json_values))
+        # if limit is 1, return data as dict not array, or None if empty
         if limit == 1:
-            json_values = json_values[0]
+            json_values = json_values[0] if json_values else None
     except ValueError as v:
-        print('serialize error')
+        annotate(request, error='serialize')
         return JsonResponse({
             'error': f'Invalid requested fields: {v}'
         }, status=400)
     else:
-        payload = {
-            'data': json_values,
-            'pageNum': page,
-            'pageCount': paginator.num_pages,
-            'hasPrevious': current_page.has_previous(),
-            'hasNext': current_page.has_next(),
-        }
-        print(f'Returning results: {payload}')
+        payload = {'data': json_values, **pagination}
         return JsonResponse(payload, safe=False)
 
 
@@ -197,61 +367,294 @@ def update(request):
     try:
         data, multi_option = sanitize_update_request(data, multi_option)
     except ValueError as v:
+        annotate(request, error='parse')
         return JsonResponse({
             'error': f'Error parsing update request: {v}'
         })
 
-    for item in data:
-        model_class = apps.get_model('network', item['model'])
-        model_instance = model_class.objects.get(id=item['id'])
+    # group items by model, so each model is fetched and written in bulk
+    updates = defaultdict(list)
+    for index, item in enumerate(data):
+        model_name = item.get('model')
         try:
-            for field, value in item.items():
-                if field not in ('model', 'id'):
-                    assert model_instance.has_edit_permissions(
-                        field, value, request.user
-                    )
-        except (PermissionError, AssertionError) as p:
+            model_class = apps.get_model('network', model_name)
+            assert issubclass(model_class, ModelExtension)
+        except (LookupError, ValueError, AttributeError, AssertionError):
+            annotate(request, error='model')
             return JsonResponse({
-                'error': f'Unauthorised request: {p}'
-            }, status=403)
-
-    result = list()
-    for item in data:
-        model_class = apps.get_model('network', item['model'])
-        model_instance = model_class.objects.get(id=item['id'])
-        serial_value = model_instance.update(item, request.user, multi_option)
-        result.append(serial_value)
+                'error': f'Model of name {model_name} does not exist'
+            }, status=400)
+        updates[model_class].append((index, item))
+    annotate(request, model=','.join(sorted(
+        model_class.__name__ for model_class in updates
+    )))
+
+    # check permissions against models fetched in one query per model, by
+    # ids converted to the primary key's type, so ids sent as strings match
+    batches = defaultdict(list)
+    for model_class, items in updates.items():
+        pks = list()
+        for _, item in items:
+            try:
+                pks.append(model_class._meta.pk.to_python(item.get('id')))
+            except ValidationError:
+                annotate(request, error='parse')
+                return JsonResponse({
+                    'error': f'Invalid id for {item["model"]} - '
+                    f'got {type(item["id"])} {item["id"]}'
+                }, status=400)
+        instances = model_class.objects.in_bulk(pks)
+        for (index, item), pk in zip(items, pks):
+            model_instance = instances.get(pk)
+            if model_instance is None:
+                annotate(request, error='missing')
+                return JsonResponse({
+                    'error': f'{item["model"]} {item["id"]} does not exist'
+                }, status=404)
+            try:
+                for field, value in item.items():
+                    if field not in ('model', 'id'):
+                        assert model_instance.has_edit_permissions(
+                            field, value, request.user
+                        )
+            except (PermissionError, AssertionError) as p:
+                annotate(request, error='permissions')
+                return JsonResponse({
+                    'error': f'Unauthorised request: {p}'
+                }, status=403)
+            batches[model_class].append((index, (model_instance, item)))
+
+    result = [None] * len(data)
+    try:
+        with transaction.atomic():
+            for model_class, batch in batches.items():
+                serial_values = model_class.update_batch(
+                    [update for _, update in batch], request.user,
+                    multi_option
+                )
+                for (index, _), serial_value in zip(batch, serial_values):
+                    result[index] = serial_value
+    except ValueError as v:
+        annotate(request, error='update')
+        return JsonResponse({
+            'error': f'Error parsing update request: {v}'
+        }, status=400)
 
+    annotate(request, rows=len(result))
     if len(result) == 1:
         result = result[0]
     return JsonResponse(result, safe=False, status=200)
 
 
 @login_required
-def create(request):
+def like(request):
+    buffer = like_buffer if use_like_buffer() else None
+    return toggle(
+        request, Post, 'likes', 'like', 'i_like', 'like_count', buffer
+    )
+
 
+@login_required
+def follow(request):
+    return toggle(
+        request, User, 'followers', 'follow', 'is_following', 'follower_count'
+    )
+
+
+def toggle(request, model, field, key, state_field, count_field,
+           buffer=None):
+    """
+    Links or unlinks the current user on a multi-link field of a model,
+    writing only the through table, so repeated or concurrent requests are
+    safe and don't contend on the model's row. If a buffer is given, the
+    link is queued and written in bulk later instead.
+    :param request: Request with the model 'id', and key set to true to link
+                    the current user or false to unlink them
+    :param model: Model class to link the current user to
+    :param field: Many-to-many field to the user on model
+    :param key: Request key of the new state
+    :param state_field: Contextual field name of the new state
+    :param count_field: Summary field name of the count of links
+    :param buffer: :class:`LinkBuffer` of the field, or None to write the
+                   link immediately
+    :return: Response with the new state and count of links
+    :rtype: JsonResponse
+    """
     if request.method != 'POST':
         return JsonResponse({
-            'error': f'Create method must be POST - got {request.method}'
+            'error': f'{key.capitalize()} must be POST - '
+            f'{request.method} not supported'
         }, status=400)
 
-    data = json.loads(request.body)
-    model_name = data.get('model')
+    annotate(request, model=model.__name__)
+    query = json.loads(request.body)
+    pk = query.get('id')
+    linked = query.get(key)
+    if not isinstance(linked, bool):
+        annotate(request, error='state')
+        return JsonResponse({
+            'error': f'{key} must be true or false - got {linked}'
+        }, status=400)
     try:
-        Model = apps.get_model('network', model_name)
-    except LookupError:
+        pk = model._meta.pk.to_python(pk)
+        assert pk is not None
+    except (ValidationError, AssertionError):
+        annotate(request, error='parse')
         return JsonResponse({
-            'error': f'Model of name {model_name} does not exist'
+            'error': f'id must be a {model._meta.model_name} id - '
+            f'got {type(pk)} {pk}'
         }, status=400)
+    # the stored links are read along with checking the model exists, so
+    # the new count only includes the change made by this request
+    state = model.link_state(pk, field, request.user.pk)
+    if state is None:
+        annotate(request, error='missing')
+        return JsonResponse({
+            'error': f'{model._meta.model_name} {pk} does not exist'
+        }, status=404)
 
-    model = Model.create_from_post(user=request.user, **data)
-    if model:
-        model.save()
-        return JsonResponse(
-            model.serialize(model.SELECT_ALL, request.user),
-            status=200)
+    try:
+        model(pk=pk).has_edit_permissions(
+            field, request.user.pk, request.user
+        )
+    except PermissionError as p:
+        annotate(request, error='permissions')
+        return JsonResponse({
+            'error': f'Unauthorised request: {p}'
+        }, status=403)
+
+    count, stored = state
+    if buffer is not None:
+        # model generations are bumped once the buffer is flushed, but the
+        # user's cached responses would hide their queued link until then
+        buffer.enqueue(pk, request.user.pk, linked)
+        bump_context(request.user)
+        changed = linked != stored
     else:
+        changed = model.toggle_link(pk, field, request.user.pk, linked)
+    if changed:
+        count += 1 if linked else -1
+
+    return JsonResponse({
+        'model': model._meta.model_name,
+        'id': pk,
+        state_field: linked,
+        count_field: count,
+    }, status=200)
+
+
+@login_required
+def export(request):
+
+    if request.method != 'GET':
         return JsonResponse({
-            # TODO: more informative response
-            'error': f'Failed to create model'
+            'error': f'Export must be GET - {request.method} not supported'
         }, status=400)
+    if not request.user.is_staff:
+        return JsonResponse({
+            'error': f'Unauthorised request: export is for staff only'
+        }, status=403)
+
+    # stream records straight from the database, a chunk at a time
+    kinds = request.GET.get('kinds')
+    kinds = kinds.split(',') if kinds else EXPORTS
+    try:
+        lines = export_lines(kinds)
+    except ValueError as v:
+        return JsonResponse({
+            'error': f'Could not export: {v}'
+        }, status=400)
+
+    response = StreamingHttpResponse(
+        lines, content_type='application/x-ndjson'
+    )
+    response['Content-Disposition'] = 'attachment; filename="network.ndjson"'
+    return response
+
+
+def metrics(request):
+
+    if request.method != 'GET':
+        return JsonResponse({
+            'error': f'Metrics must be GET - {request.method} not supported'
+        }, status=400)
+
+    # scrapers can't log in, so may authenticate with the metrics token
+    token = metrics_token()
+    authorization = request.headers.get('Authorization', '')
+    scraper = token and hmac.compare_digest(
+        authorization.encode(), f'Bearer {token}'.encode()
+    )
+    if not scraper and not request.user.is_staff:
+        return JsonResponse({
+            'error': f'Unauthorised request: metrics are for staff only'
+        }, status=403)
+
+    return HttpResponse(
+        registry.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+@login_required
+def create(request):
+
+    if request.method != 'POST':
+        return JsonResponse({
+            'error': f'Create method must be POST - got {request.method}'
+        }, status=400)
+
+    # a list of items is created in bulk, in a single transaction
+    data = json.loads(request.body)
+    many = isinstance(data, list)
+    items = data if many else [data]
+
+    created = defaultdict(list)
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            annotate(request, error='parse')
+            return JsonResponse({
+                'error': f'Items to create must be json objects - got '
+                f'{type(item)}' + (f' - item {index}' if many else '')
+            }, status=400)
+        model_name = item.get('model')
+        try:
+            Model = apps.get_model('network', model_name)
+            assert issubclass(Model, ModelExtension)
+        except (LookupError, ValueError, AttributeError, AssertionError):
+            annotate(request, error='model')
+            return JsonResponse({
+                'error': f'Model of name {model_name} does not exist'
+            }, status=400)
+
+        model = Model.create_from_post(user=request.user, **item)
+        if not model:
+            annotate(request, error='invalid')
+            return JsonResponse({
+                # TODO: more informative response
+                'error': f'Failed to create model'
+                + (f' - item {index}' if many else '')
+            }, status=400)
+        created[Model].append((index, model))
+    annotate(request, model=','.join(sorted(
+        Model.__name__ for Model in created
+    )))
+
+    with transaction.atomic():
+        for Model, models in created.items():
+            Model.create_batch([model for _, model in models])
+
+    # serialize created models with one planned query per model
+    result = [None] * len(items)
+    for Model, models in created.items():
+        values = Model.plan_queryset(
+            Model.objects.filter(pk__in=[model.pk for _, model in models]),
+            Model.SELECT_ALL, request.user
+        ).in_bulk()
+        for index, model in models:
+            result[index] = values[model.pk].serialize(
+                Model.SELECT_ALL, request.user
+            )
+
+    annotate(request, rows=len(result))
+    return JsonResponse(result if many else result[0], safe=False, status=200)
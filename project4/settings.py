@@ -43,11 +43,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'network.middleware.RequestLogMiddleware',
+    'network.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'network.middleware.SerializeProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -85,6 +88,18 @@ DATABASES = {
 
 AUTH_USER_MODEL = "network.User"
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Local memory is per process, use a shared backend (e.g. memcached) when
+# running multiple processes, so cached search responses are invalidated
+# by writes in any of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -122,3 +137,78 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Network app
+
+# Read like/follower/leader counts from their counter columns rather than
+# counting the relation. Counters are maintained on every update, run
+# `manage.py reconcile_counters` after writing links any other way.
+NETWORK_COUNTER_COLUMNS = False
+
+# Read home feeds from a timeline table populated when posts are created and
+# follows change, rather than joining through followers on every read. Run
+# `manage.py build_timeline` when enabling on an existing database.
+NETWORK_TIMELINE = False
+
+# Posts by users with more followers than this are not copied to each
+# follower's timeline, and are merged into feeds at read time instead.
+NETWORK_TIMELINE_FAN_OUT_LIMIT = 1000
+
+# Seconds search responses are cached for, keyed by query and invalidated
+# by writes to any model. Set to 0 to disable. Invalidation goes through
+# generation counters in the cache, so with a cache local to each process
+# other processes serve stale results until the timeout. If None, cached
+# for 60 seconds unless the default cache is local memory or a dummy cache.
+NETWORK_SEARCH_CACHE_TIMEOUT = None
+
+# Give search responses ETags, so browsers revalidate them rather than
+# downloading them again. ETags come from generation counters kept in the
+# cache, so need a cache shared by every process. If None, enabled unless
+# the default cache is local memory or a dummy cache.
+NETWORK_SEARCH_ETAGS = None
+
+# Queue like toggles in memory and write them in bulk every
+# NETWORK_LINK_BUFFER_INTERVAL seconds, rather than on each request. Users
+# see their own queued likes straight away, other users once written.
+NETWORK_LIKE_BUFFER = False
+NETWORK_LINK_BUFFER_INTERVAL = 1.0
+
+# Fraction of requests logged by network.middleware.RequestLogMiddleware, by
+# url name, with 'default' for the rest. Failed requests are always logged.
+NETWORK_LOG_SAMPLING = {
+    'default': 1.0,
+}
+
+# Time serializing each field of every request and log the breakdown, see
+# network.middleware.SerializeProfileMiddleware. Otherwise only requests by
+# staff users with the X-Profile-Serialize header are profiled.
+NETWORK_PROFILE_SERIALIZE = False
+
+# Directory shared by all processes serving the app, where each writes its
+# metrics every NETWORK_METRICS_INTERVAL seconds so the metrics endpoint can
+# expose totals across processes. If None, each process exposes its own.
+NETWORK_METRICS_DIR = None
+NETWORK_METRICS_INTERVAL = 10.0
+
+# Metrics are only served to staff users, and to scrapers sending this
+# token in an "Authorization: Bearer <token>" header. Keep it secret.
+NETWORK_METRICS_TOKEN = os.environ.get('NETWORK_METRICS_TOKEN')
+
+# Failed requests are logged at WARNING, and the sampled successful ones at
+# INFO, so set NETWORK_LOG_LEVEL=INFO to log them too.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'network': {
+            'handlers': ['console'],
+            'level': os.environ.get('NETWORK_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}